@@ -1,10 +1,16 @@
-from fastapi import FastAPI, Response, Header, status
+from fastapi import FastAPI, Request, Response, Header, status
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
 from typing import Union
 from typing_extensions import Annotated
 import uvicorn
 import os
+import threading
+import json
+import hashlib
 from dotenv import load_dotenv
 from main import Main
+from database.mongodb import MongoDB
 import logging
 import traceback
 from pydantic import BaseModel
@@ -19,12 +25,21 @@ class Post(BaseModel):
   days: int = 2
   numArticles: int = 3
   insightIds: list = [] # TODO: Replace array with text and split items by comma
-  role: str = 'You are a board advisor operating as Chenot Consulting Ltd.'
+  role: str = '' # Defaults to the role of the user's prompt template
   post_prompt: str = ''
   image_prompt: str = f'Generate an image based on the following LinkedIn post:'
 
 load_dotenv()
 app = FastAPI()
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+@app.on_event("startup")
+def prewarmDependencies():
+  # Delay the prewarm so the server is listening and answering health checks first
+  if os.getenv('PREWARM', 'true').lower() == 'true':
+    prewarm = threading.Timer(float(os.getenv('PREWARM_DELAY', 1)), Main.prewarm)
+    prewarm.daemon = True
+    prewarm.start()
 
 def authoriseRequest(x_api_key):
    auth_api_key = os.getenv('AUTH_API_KEY')
@@ -33,6 +48,11 @@ def authoriseRequest(x_api_key):
    else:
       return False
 
+@app.on_event("shutdown")
+def flushWriteBehind():
+  if MongoDB.write_behind is not None:
+    MongoDB.write_behind.close()
+
 @app.post("/marketing/feedly/insights", status_code=status.HTTP_200_OK)
 def generateFeedlyInsights(insights: Insights, response: Response, x_api_key: Annotated[Union[str, None], Header()] = None):
   try: 
@@ -61,7 +81,8 @@ def generateFeedlyInsights(insights: Insights, response: Response, x_api_key: An
           "status": "OK",
           "results": {
             "insights": insights[0] if insights is not None else "No insights.",
-            "urls": insights[1] if insights is not None else "No URLs."
+            "urls": insights[1] if insights is not None else "No URLs.",
+            "id": insights[2] if insights is not None else None
           }
         }          
 
@@ -111,7 +132,8 @@ def generateInoreaderInsights(insights: Insights, response: Response, x_api_key:
           "status": "OK",
           "results": {
             "insights": insights[0] if insights is not None else "No insights.",
-            "urls": insights[1] if insights is not None else "No URLs."
+            "urls": insights[1] if insights is not None else "No URLs.",
+            "id": insights[2] if insights is not None else None
           }
         }          
 
@@ -162,7 +184,8 @@ def generateFeedlyInsightsLinkedInPost(post: Post, response: Response, x_api_key
           "results": {
             "post": post[0],
             "urls": post[1],
-            "image": post[2]
+            "image": post[2],
+            "id": post[3]
           }
         }
 
@@ -212,7 +235,8 @@ def generateInoreaderInsightsLinkedInPost(post: Post, response: Response, x_api_
           "results": {
             "post": post[0],
             "urls": post[1],
-            "image": post[2]
+            "image": post[2],
+            "id": post[3]
           }
         }
 
@@ -233,6 +257,52 @@ def generateInoreaderInsightsLinkedInPost(post: Post, response: Response, x_api_
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
     return error
 
+def getHistory(collection, request, userId, limit, after, fields, x_api_key):
+  if not authoriseRequest(x_api_key):
+    results = {
+      "status": "Not Authorized",
+      "message": "You are not authorized to access this service."
+    }
+    return JSONResponse(content=results, status_code=status.HTTP_401_UNAUTHORIZED)
+
+  try:
+    main = Main()
+    fields = [field.strip() for field in fields.split(',') if field.strip()] if fields else None
+    documents, next_cursor = main.findHistory(collection=collection, userId=userId, limit=max(1, min(limit, 100)), after=after, fields=fields)
+    results = {
+      "status": "OK",
+      "results": documents,
+      "next": next_cursor
+    }
+  except ValueError as e:
+    results = {
+      "status": "Bad Request",
+      "message": f"{e}"
+    }
+    return JSONResponse(content=results, status_code=status.HTTP_400_BAD_REQUEST)
+  except Exception as e:
+    error = {
+      "status": "Error", 
+      "message": f"Error getting {collection} history: {e}"
+    }
+    logging.error(error)
+    return JSONResponse(content=error, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+  # Unchanged pages are answered with a 304 and no body
+  etag = f'"{hashlib.sha256(json.dumps(results, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:32]}"'
+  if request.headers.get('if-none-match') == etag:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+  return JSONResponse(content=results, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+@app.get("/marketing/insights", status_code=status.HTTP_200_OK)
+def listInsights(request: Request, userId: str, limit: int = 20, after: Union[str, None] = None, fields: Union[str, None] = None, x_api_key: Annotated[Union[str, None], Header()] = None):
+  return getHistory('insight', request, userId, limit, after, fields, x_api_key)
+
+@app.get("/marketing/linkedinposts", status_code=status.HTTP_200_OK)
+def listLinkedInPosts(request: Request, userId: str, limit: int = 20, after: Union[str, None] = None, fields: Union[str, None] = None, x_api_key: Annotated[Union[str, None], Header()] = None):
+  return getHistory('linkedin_post', request, userId, limit, after, fields, x_api_key)
+
 @app.get("/marketing/health", status_code=status.HTTP_200_OK)
 def checkHealth():
   result = {
@@ -241,6 +311,26 @@ def checkHealth():
   logging.info(result)
   return result
 
+@app.get("/marketing/metrics", status_code=status.HTTP_200_OK)
+def getMetrics(response: Response, x_api_key: Annotated[Union[str, None], Header()] = None):
+  if authoriseRequest(x_api_key):
+    return {
+      "status": "OK",
+      "results": {
+        "articleFetches": Main.downloader.getStats(),
+        "configCache": Main.config_cache.getStats(),
+        "promptUsage": Main.prompt_usage.getStats(),
+        "writeBehind": MongoDB.write_behind.getStats() if MongoDB.write_behind is not None else None
+      }
+    }
+  else:
+    results = {
+      "status": "Not Authorized",
+      "message": "You are not authorized to access this service."
+    }
+    response.status_code = status.HTTP_401_UNAUTHORIZED
+    return results
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     logging.info("Starting webserver...")
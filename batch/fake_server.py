@@ -0,0 +1,95 @@
+import os
+import json
+import uuid
+import logging
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Stand-in for the OpenAI batch API when testing deferred runs locally:
+#   python batch/fake_server.py
+#   OPENAI_BATCH_URL=http://127.0.0.1:8090/v1 OPENAI_BATCH_POLL_INTERVAL=1 python main.py 3 --deferred
+FILES = {}
+BATCHES = {}
+
+def fakeCompletion(body):
+    prompt = body['messages'][-1]['content']
+    return {
+        'id': f'chatcmpl-{uuid.uuid4().hex}',
+        'object': 'chat.completion',
+        'model': body.get('model'),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': f'[fake batch completion] {prompt[:200]}'}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': len(prompt.split()), 'completion_tokens': 10, 'total_tokens': len(prompt.split()) + 10, 'prompt_tokens_details': {'cached_tokens': 0}}
+    }
+
+class FakeBatchHandler(BaseHTTPRequestHandler):
+    def sendJson(self, content, status=200):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def readBody(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        if self.path == '/v1/files':
+            # Parse the multipart upload with the email parser, as the batch file is its only file part
+            message = BytesParser().parsebytes(f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode('utf-8') + self.readBody())
+            content = next(part.get_payload(decode=True) for part in message.get_payload() if part.get_filename())
+            file_id = f'file-{uuid.uuid4().hex}'
+            FILES[file_id] = content.decode('utf-8')
+            self.sendJson({'id': file_id, 'object': 'file', 'purpose': 'batch', 'bytes': len(content)})
+        elif self.path == '/v1/batches':
+            request = json.loads(self.readBody())
+            lines = [json.loads(line) for line in FILES[request['input_file_id']].splitlines() if line.strip()]
+            output_id = f'file-{uuid.uuid4().hex}'
+            FILES[output_id] = '\n'.join(json.dumps({
+                'id': f'batch_req_{uuid.uuid4().hex}',
+                'custom_id': line['custom_id'],
+                'response': {'status_code': 200, 'body': fakeCompletion(line['body'])},
+                'error': None
+            }) for line in lines) + '\n'
+
+            batch_id = f'batch_{uuid.uuid4().hex}'
+            BATCHES[batch_id] = {
+                'id': batch_id,
+                'object': 'batch',
+                'endpoint': request['endpoint'],
+                'input_file_id': request['input_file_id'],
+                'output_file_id': output_id,
+                'error_file_id': None,
+                'status': 'validating',
+                'request_counts': {'total': len(lines), 'completed': 0, 'failed': 0}
+            }
+            self.sendJson(BATCHES[batch_id])
+        else:
+            self.sendJson({'error': {'message': f'Unknown path {self.path}'}}, status=404)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 3 and parts[1] == 'batches' and parts[2] in BATCHES:
+            # Go through in_progress once so clients exercise their polling
+            batch = BATCHES[parts[2]]
+            if batch['status'] == 'validating':
+                batch['status'] = 'in_progress'
+            else:
+                batch['status'] = 'completed'
+                batch['request_counts']['completed'] = batch['request_counts']['total']
+            self.sendJson(batch)
+        elif len(parts) == 4 and parts[1] == 'files' and parts[3] == 'content' and parts[2] in FILES:
+            body = FILES[parts[2]].encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/jsonl')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.sendJson({'error': {'message': f'Unknown path {self.path}'}}, status=404)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    port = int(os.getenv('FAKE_BATCH_PORT', 8090))
+    logging.info(f'Fake batch server listening on port {port}')
+    ThreadingHTTPServer(('127.0.0.1', port), FakeBatchHandler).serve_forever()
@@ -0,0 +1,99 @@
+import os
+import io
+import json
+import time
+import logging
+import requests
+
+class BatchClient():
+    """
+    Submits chat completions through an OpenAI-compatible batch API and collects the results
+    """
+    FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+    def __init__(self, api_key, model):
+        self.base_url = os.getenv('OPENAI_BATCH_URL', 'https://api.openai.com/v1').rstrip('/')
+        self.poll_interval = float(os.getenv('OPENAI_BATCH_POLL_INTERVAL', 60))
+        self.timeout = float(os.getenv('OPENAI_BATCH_TIMEOUT', 24 * 3600))
+        self.model = model
+
+        self.session = requests.Session()
+        self.session.headers = {'Authorization': f'Bearer {api_key}'}
+
+    def buildInput(self, prompts):
+        lines = []
+        for custom_id, role, prompt in prompts:
+            lines.append(json.dumps({
+                'custom_id': custom_id,
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': {
+                    'model': self.model,
+                    'temperature': 0.2,
+                    'n': 1,
+                    'messages': [
+                        {'role': 'system', 'content': role},
+                        {'role': 'user', 'content': prompt}
+                    ]
+                }
+            }))
+        return '\n'.join(lines) + '\n'
+
+    def submit(self, prompts):
+        """
+        Upload the prompts as a JSONL file and create the batch
+        """
+        batch_input = io.BytesIO(self.buildInput(prompts).encode('utf-8'))
+        file_response = self.session.post(f'{self.base_url}/files', data={'purpose': 'batch'}, files={'file': ('batch.jsonl', batch_input, 'application/jsonl')}, timeout=60)
+        file_response.raise_for_status()
+
+        batch_response = self.session.post(f'{self.base_url}/batches', json={
+            'input_file_id': file_response.json()['id'],
+            'endpoint': '/v1/chat/completions',
+            'completion_window': '24h'
+        }, timeout=60)
+        batch_response.raise_for_status()
+
+        batch = batch_response.json()
+        logging.info(f'Submitted batch {batch["id"]} with {len(prompts)} prompts')
+        return batch['id']
+
+    def wait(self, batch_id):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            response = self.session.get(f'{self.base_url}/batches/{batch_id}', timeout=60)
+            response.raise_for_status()
+            batch = response.json()
+            logging.info(f'Batch {batch_id} status: {batch["status"]}, request counts: {batch.get("request_counts")}')
+
+            if batch['status'] in self.FINAL_STATUSES:
+                return batch
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Batch {batch_id} did not complete within {self.timeout} seconds')
+            time.sleep(self.poll_interval)
+
+    def results(self, batch):
+        """
+        Return the chat completion of each prompt, keyed by custom ID
+        """
+        results = {}
+        for file_id in [batch.get('output_file_id'), batch.get('error_file_id')]:
+            if not file_id:
+                continue
+
+            response = self.session.get(f'{self.base_url}/files/{file_id}/content', timeout=60)
+            response.raise_for_status()
+            for line in response.text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                body = (result.get('response') or {}).get('body')
+                if result.get('error') is None and body is not None:
+                    results[result['custom_id']] = body
+                else:
+                    logging.error(f'Batch request {result.get("custom_id")} failed: {result.get("error") or result.get("response")}')
+
+        return results
+
+    def run(self, prompts):
+        return self.results(self.wait(self.submit(prompts)))
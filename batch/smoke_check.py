@@ -0,0 +1,39 @@
+import os
+import sys
+import logging
+import threading
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from batch.fake_server import FakeBatchHandler
+
+def runSmokeCheck():
+    """
+    Run a batch through BatchClient against the fake batch server and check every prompt gets its completion
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBatchHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ['OPENAI_BATCH_URL'] = f'http://127.0.0.1:{server.server_address[1]}/v1'
+    os.environ['OPENAI_BATCH_POLL_INTERVAL'] = '0.1'
+    os.environ['OPENAI_BATCH_TIMEOUT'] = '30'
+
+    try:
+        from batch.openai_batch import BatchClient
+        prompts = [(f'request-{index}', 'You are a research analyst.', f'Extract the key insights from folder {index}') for index in range(3)]
+        results = BatchClient(api_key='fake', model='chatgpt-4o-latest').run(prompts)
+
+        missing = [custom_id for custom_id, role, prompt in prompts if custom_id not in results]
+        if len(missing) > 0:
+            raise AssertionError(f'No results for {missing}')
+        for custom_id, role, prompt in prompts:
+            content = results[custom_id]['choices'][0]['message']['content']
+            if prompt not in content:
+                raise AssertionError(f'Unexpected completion for {custom_id}: {content}')
+
+        logging.info(f'Batch smoke check passed with {len(results)} results')
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    runSmokeCheck()
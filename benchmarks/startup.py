@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['selenium', 'bs4', 'tiktoken', 'openai', 'numpy', 'pymongo', 'smtplib']
+
+def measureImport():
+    """
+    Time the import of the API module in a fresh interpreter and list the heavy modules it loaded
+    """
+    code = (
+        'import sys, time, json\n'
+        'start = time.perf_counter()\n'
+        'import app\n'
+        'elapsed = time.perf_counter() - start\n'
+        f'print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {HEAVY_MODULES} if m in sys.modules]}}))\n'
+    )
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def measureFirstHealthyResponse(port):
+    """
+    Time from launching the server to the first 200 from the health check
+    """
+    env = dict(os.environ, PORT=str(port), LOG_LEVEL='warning')
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, 'app.py'], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        while time.perf_counter() - start < 60:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/marketing/health', timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.05)
+        raise TimeoutError('The server did not become healthy within 60 seconds')
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the cold start of the API')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--max-import', type=float, default=None, help='Fail if importing app takes longer than this many seconds')
+    parser.add_argument('--max-healthy', type=float, default=None, help='Fail if the first healthy response takes longer than this many seconds')
+    args = parser.parse_args()
+
+    imported = measureImport()
+    healthy = measureFirstHealthyResponse(args.port)
+    results = {
+        'importSeconds': round(imported['seconds'], 3),
+        'heavyModulesLoaded': imported['loaded'],
+        'firstHealthySeconds': round(healthy, 3)
+    }
+    print(json.dumps(results, indent=2))
+
+    failed = len(imported['loaded']) > 0
+    if args.max_import is not None and imported['seconds'] > args.max_import:
+        failed = True
+    if args.max_healthy is not None and healthy > args.max_healthy:
+        failed = True
+
+    sys.exit(1 if failed else 0)
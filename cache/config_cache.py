@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+
+class ConfigCache():
+    """
+    In-process LRU cache of user configs and their ready-to-use clients
+    """
+    def __init__(self):
+        self.max_size = int(os.getenv('CONFIG_CACHE_SIZE', 256))
+        self.ttl = float(os.getenv('CONFIG_CACHE_TTL', 300))
+        self.entries = OrderedDict()
+        self.user_ids = {}
+        self.lock = threading.Lock()
+        self.watcher = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.load_seconds = deque(maxlen=500)
+
+    def isWatching(self):
+        return self.watcher is not None and self.watcher.is_alive()
+
+    def remove(self, userId):
+        entry = self.entries.pop(userId, None)
+        if entry is not None:
+            self.user_ids.pop(entry['documentId'], None)
+        return entry
+
+    def get(self, userId, loadVersion=None):
+        """
+        Return the cached entry, checking its version with loadVersion when the change stream is not watching
+        """
+        with self.lock:
+            entry = self.entries.get(userId)
+            if entry is not None and time.monotonic() - entry['loadedAt'] > self.ttl:
+                self.remove(userId)
+                entry = None
+
+        if entry is not None and loadVersion is not None and not self.isWatching():
+            current = loadVersion()
+            if current is None or current.get('version') != entry['version']:
+                self.invalidate(userId=userId)
+                entry = None
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(userId)
+            self.hits += 1
+            return entry
+
+    def put(self, userId, config, clients, load_seconds):
+        with self.lock:
+            self.entries[userId] = {
+                'config': config,
+                'version': config.get('version'),
+                'clients': clients,
+                'documentId': config.get('_id'),
+                'loadedAt': time.monotonic()
+            }
+            self.entries.move_to_end(userId)
+            self.user_ids[config.get('_id')] = userId
+            self.load_seconds.append(load_seconds)
+
+            while len(self.entries) > self.max_size:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, userId=None, documentId=None, version=None):
+        """
+        Drop the cached entry of a user, unless it already holds the given version of the config
+        """
+        with self.lock:
+            if userId is None:
+                userId = self.user_ids.get(documentId)
+
+            entry = self.entries.get(userId)
+            if entry is not None and (version is None or entry['version'] != version):
+                self.remove(userId)
+                self.invalidations += 1
+                logging.info(f'Invalidated cached config for user {userId}')
+
+    def watch(self, mongo):
+        """
+        Invalidate entries from a change stream on the config collection
+        """
+        if os.getenv('CONFIG_CACHE_WATCH', 'false').lower() != 'true':
+            return
+
+        with self.lock:
+            if self.watcher is not None and self.watcher.is_alive():
+                return
+            self.watcher = threading.Thread(target=self.processChanges, args=(mongo,), daemon=True)
+            self.watcher.start()
+
+    def processChanges(self, mongo):
+        try:
+            with mongo.watchConfigs() as stream:
+                for change in stream:
+                    document = change.get('fullDocument') or {}
+                    self.invalidate(userId=document.get('userId'), documentId=change.get('documentKey', {}).get('_id'), version=document.get('version'))
+        except Exception as e:
+            # Without the change stream, the TTL still bounds how stale a config can get
+            logging.error(f'Config change stream stopped: \n{e}')
+
+    def getStats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            load_seconds = sorted(self.load_seconds)
+
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRatio': round(self.hits / requests, 3) if requests > 0 else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'loadAvg': round(sum(load_seconds) / len(load_seconds), 3) if load_seconds else None,
+                'loadP95': load_seconds[min(len(load_seconds) - 1, int(0.95 * len(load_seconds)))] if load_seconds else None
+            }
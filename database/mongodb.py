@@ -2,19 +2,50 @@ import os
 import logging
 import json
 from datetime import datetime
+import threading
+import base64
 from dotenv import load_dotenv
-from pymongo.mongo_client import MongoClient
-from pymongo.collection import ObjectId
+from database.writebehind import WriteBehindQueue
 
 class MongoDB():
     load_dotenv()
+    # Fields returned by the history endpoints when none are requested, leaving out the large text bodies
+    HISTORY_FIELDS = {
+        'insight': ['userId', 'urls', 'timestamp'],
+        'linkedin_post': ['userId', 'insightIds', 'image', 'urls', 'timestamp']
+    }
+    HISTORY_ALLOWED_FIELDS = {
+        'insight': ['userId', 'insights', 'urls', 'timestamp'],
+        'linkedin_post': ['userId', 'insightIds', 'post', 'image', 'urls', 'timestamp']
+    }
+    history_indexes = set()
+    article_index = False
+    # One client per process, as each MongoClient resolves the SRV record and runs its own monitor threads
+    shared_client = None
+    shared_client_lock = threading.Lock()
+    # Shared by all instances so documents from every request are flushed together
+    write_behind = None
+    write_behind_lock = threading.Lock()
 
     def __init__(self):
         logging.basicConfig(level=logging.DEBUG)
         self.uri = f"mongodb+srv://{os.getenv('MONGODB_USERNAME')}:{os.getenv('MONGODB_PASSWORD')}@{os.getenv('MONGODB_URL', 'insightsautomation.to3so7y.mongodb.net')}/?retryWrites=true&w=majority"
 
-        # Create a new client and connect to the server
-        self.client = MongoClient(self.uri)
+        # Create the client of the process and connect to the server. pymongo is imported here to keep cold starts fast
+        with MongoDB.shared_client_lock:
+            if MongoDB.shared_client is None:
+                from pymongo.mongo_client import MongoClient
+                MongoDB.shared_client = MongoClient(self.uri)
+        self.client = MongoDB.shared_client
+
+    def getWriteBehind(self):
+        if os.getenv('WRITE_BEHIND', 'true').lower() != 'true':
+            return None
+
+        with MongoDB.write_behind_lock:
+            if MongoDB.write_behind is None:
+                MongoDB.write_behind = WriteBehindQueue(self.client)
+        return MongoDB.write_behind
 
     def testConnection(self):
         # Send a ping to confirm a successful connection
@@ -35,37 +66,180 @@ class MongoDB():
             logging.error(f'Error getting config for user {userId}: \n{e}')
             raise Exception(e)
         
+    def findConfigVersion(self, userId):
+        db = self.client.get_database(name='InsightsAutomation')
+        coll = db.get_collection('config')
+        return coll.find_one({"userId": userId}, {"_id": 0, "version": 1})
+
+    def watchConfigs(self):
+        db = self.client.get_database(name='InsightsAutomation')
+        coll = db.get_collection('config')
+        return coll.watch(full_document='updateLookup')
+
+    def findFeedState(self, source, userId, folderId):
+        db = self.client.get_database(name='InsightsAutomation')
+        coll = db.get_collection('feed_state')
+        return coll.find_one({"source": source, "userId": userId, "folderId": folderId}, {"_id": 0, "etag": 1, "lastModified": 1, "newest": 1})
+
+    def saveFeedState(self, source, userId, folderId, state):
+        db = self.client.get_database(name='InsightsAutomation')
+        coll = db.get_collection('feed_state')
+        coll.update_one(
+            {"source": source, "userId": userId, "folderId": folderId},
+            {"$set": {**state, "timestamp": int(datetime.now().timestamp())}},
+            upsert=True
+        )
+        logging.info(f'Saved {source} poll state for folder {folderId} of user {userId}')
+
     def findInsightById(self, insightId): 
         try:
             db = self.client.get_database(name='InsightsAutomation')
             coll = db.get_collection('insight')
+            from bson.objectid import ObjectId
             insight = coll.find_one({"_id": ObjectId(insightId)})
+            if insight is None and MongoDB.write_behind is not None:
+                insight = MongoDB.write_behind.findPending('insight', insightId)
+                if insight is None:
+                    # It may have been flushed between the two lookups
+                    insight = coll.find_one({"_id": ObjectId(insightId)})
             logging.info(f'Found insight for ID: {insightId}')
             return insight
         except Exception as e:
             logging.error(f'Error getting insight for ID {insightId}: \n{e}')
             raise Exception(e)
 
+    def ensureHistoryIndex(self, coll):
+        if coll.name not in MongoDB.history_indexes:
+            coll.create_index([("userId", 1), ("timestamp", -1), ("_id", -1)], name='userId_timestamp_id')
+            MongoDB.history_indexes.add(coll.name)
+
+    def encodeCursor(self, document):
+        return base64.urlsafe_b64encode(f'{document["timestamp"]}:{document["_id"]}'.encode('utf-8')).decode('utf-8')
+
+    def decodeCursor(self, cursor):
+        from bson.objectid import ObjectId
+        try:
+            timestamp, documentId = base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8').split(':')
+            return int(timestamp), ObjectId(documentId)
+        except Exception:
+            raise ValueError(f'Invalid cursor: {cursor}')
+
+    def findHistory(self, collection, userId, limit=20, after=None, fields=None):
+        """
+        Return a page of the user's documents, newest first, and the cursor of the next page
+        """
+        fields = fields or MongoDB.HISTORY_FIELDS[collection]
+        invalid_fields = [field for field in fields if field not in MongoDB.HISTORY_ALLOWED_FIELDS[collection]]
+        if len(invalid_fields) > 0:
+            raise ValueError(f'Invalid fields: {invalid_fields}')
+
+        query = {"userId": userId}
+        if after:
+            # Keyset pagination so deep pages do not scan and skip the previous ones
+            timestamp, documentId = self.decodeCursor(after)
+            query["$or"] = [
+                {"timestamp": {"$lt": timestamp}},
+                {"timestamp": timestamp, "_id": {"$lt": documentId}}
+            ]
+
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection(collection)
+            self.ensureHistoryIndex(coll)
+            projection = {field: 1 for field in fields + ['timestamp']}
+            documents = list(coll.find(query, projection).sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1))
+            logging.info(f'Found {len(documents)} documents in {collection} collection for user {userId}')
+        except Exception as e:
+            logging.error(f'Error getting {collection} history for user {userId}: \n{e}')
+            raise Exception(e)
+
+        next_cursor = self.encodeCursor(documents[limit - 1]) if len(documents) > limit else None
+        documents = documents[:limit]
+        for document in documents:
+            document["_id"] = str(document["_id"])
+
+        return documents, next_cursor
+
+    def getArticleCollection(self):
+        db = self.client.get_database(name='InsightsAutomation')
+        coll = db.get_collection('article')
+        if not MongoDB.article_index:
+            coll.create_index("urlHash", unique=True, name='urlHash')
+            MongoDB.article_index = True
+        return coll
+
+    def findArticle(self, urlHash):
+        try:
+            return self.getArticleCollection().find_one({"urlHash": urlHash})
+        except Exception as e:
+            logging.error(f'Error getting article {urlHash}: \n{e}')
+            return None
+
+    def saveArticle(self, article):
+        try:
+            self.getArticleCollection().update_one({"urlHash": article["urlHash"]}, {"$set": article}, upsert=True)
+            logging.info(f'Stored article {article["url"]}')
+        except Exception as e:
+            logging.error(f'Error storing article {article["url"]}: \n{e}')
+
+    def acquireArticleLease(self, urlHash, owner, seconds):
+        """
+        Take the lease to scrape the article, unless another worker holds an unexpired one
+        """
+        from pymongo.errors import DuplicateKeyError
+        now = datetime.now().timestamp()
+        db = self.client.get_database(name='InsightsAutomation')
+        coll = db.get_collection('article_lease')
+        try:
+            coll.update_one(
+                {"_id": urlHash, "$or": [{"expiresAt": {"$lt": now}}, {"owner": owner}]},
+                {"$set": {"owner": owner, "expiresAt": now + seconds}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+        except Exception as e:
+            # Scraping twice is better than not scraping at all
+            logging.error(f'Error acquiring article lease {urlHash}: \n{e}')
+            return True
+
+    def releaseArticleLease(self, urlHash, owner):
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            db.get_collection('article_lease').delete_one({"_id": urlHash, "owner": owner})
+        except Exception as e:
+            logging.error(f'Error releasing article lease {urlHash}: \n{e}')
+
     def insertInsights(self, userId, insights, urls):
+        from bson.objectid import ObjectId
         insight_document = {
+            "_id": ObjectId(),
             "userId": userId,
             "insights": insights,
             "urls": urls,
             "timestamp": int(datetime.now().timestamp())
         }
 
+        write_behind = self.getWriteBehind()
+        if write_behind is not None:
+            logging.info(f'Queued document for insights collection for user {userId}')
+            return write_behind.enqueue('insight', insight_document)
+
         try:
             db = self.client.get_database(name='InsightsAutomation')
             coll = db.get_collection('insight')
             coll.insert_one(insight_document)
             logging.info(f'Inserted document in insights collection for user {userId}')
-            return True
+            return str(insight_document['_id'])
         except Exception as e:
             logging.error(f'Error inserting insights document for user {userId}: \n{e}')
             raise Exception(e)
         
     def insertPost(self, userId, post, image, insightIds, urls = []):
+        from bson.objectid import ObjectId
         insight_document = {
+            "_id": ObjectId(),
             "userId": userId,
             "insightIds": insightIds,
             "post": post,
@@ -74,12 +248,17 @@ class MongoDB():
             "timestamp": int(datetime.now().timestamp())
         }
 
+        write_behind = self.getWriteBehind()
+        if write_behind is not None:
+            logging.info(f'Queued document for post collection for user {userId} from insights: {insightIds}')
+            return write_behind.enqueue('linkedin_post', insight_document)
+
         try:
             db = self.client.get_database(name='InsightsAutomation')
             coll = db.get_collection('linkedin_post')
             coll.insert_one(insight_document)
             logging.info(f'Inserted document in post collection for user {userId} from insights: {insightIds}')
-            return True
+            return str(insight_document['_id'])
         except Exception as e:
             logging.error(f'Error inserting post document for user {userId} from insights: {insightIds}: \n{e}')
             raise Exception(e)
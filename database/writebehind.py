@@ -0,0 +1,248 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+
+class WriteBehindQueue():
+    """
+    Buffers documents and writes them to MongoDB in bulk from a background thread
+    """
+    # Server errors worth retrying: shutting down, no primary, network errors and timeouts
+    RETRYABLE_CODES = (6, 7, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436)
+
+    def __init__(self, client):
+        from bson import json_util
+        self.json_util = json_util
+        self.client = client
+        self.batch_size = int(os.getenv('WRITE_BEHIND_BATCH_SIZE', 50))
+        self.flush_interval = float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', 2))
+        self.spool_path = os.getenv('WRITE_BEHIND_SPOOL', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'writebehind.spool'))
+
+        self.buffer = []
+        self.inflight = []
+        self.spooled = self.countSpooled()
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.flushed = 0
+        self.failed_flushes = 0
+        self.dead_letters = 0
+        self.flush_seconds = deque(maxlen=500)
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+        atexit.register(self.close)
+
+    def enqueue(self, collection, document):
+        """
+        Queue the document for insertion and return its client-side generated ID
+        """
+        with self.condition:
+            self.buffer.append((collection, document))
+            if len(self.buffer) >= self.batch_size:
+                self.condition.notify()
+
+        return str(document['_id'])
+
+    def findPending(self, collection, documentId):
+        """
+        Find a document that is queued, being flushed or waiting in the spool file
+        """
+        with self.condition:
+            pending = self.buffer + self.inflight
+
+        if self.spooled > 0:
+            try:
+                pending += self.readSpool(quarantine=False)
+            except Exception as e:
+                logging.warning(f'Could not read the write-behind spool: {e}')
+
+        for pending_collection, document in pending:
+            if pending_collection == collection and str(document['_id']) == str(documentId):
+                return document
+        return None
+
+    def run(self):
+        while True:
+            try:
+                with self.condition:
+                    self.condition.wait(timeout=self.flush_interval)
+                self.flush()
+            except Exception as e:
+                # Keep the flusher alive, the documents are back in the buffer for the next flush
+                logging.error(f'Error in the write-behind flusher: \n{e}')
+
+    def flush(self):
+        with self.flush_lock:
+            with self.condition:
+                pending = self.buffer
+                self.buffer = []
+                self.inflight = pending
+
+            try:
+                spooled = self.readSpool() if self.spooled > 0 else []
+                batch = spooled + pending
+                if len(batch) == 0:
+                    return
+
+                start = time.monotonic()
+                try:
+                    retry, dead = self.write(batch)
+                except Exception as e:
+                    retry, dead = batch, []
+                    logging.error(f'Error flushing {len(batch)} documents to MongoDB: \n{e}')
+                finally:
+                    self.flush_seconds.append(round(time.monotonic() - start, 3))
+
+                self.flushed += len(batch) - len(retry) - len(dead)
+                if len(dead) > 0:
+                    self.writeDeadLetters(dead)
+                if len(retry) > 0:
+                    # Only the documents that still need writing stay in the spool file
+                    self.failed_flushes += 1
+                    logging.error(f'Could not write {len(retry)} of {len(batch)} documents to MongoDB, spooling them for retry')
+                    self.replaceSpool(retry)
+                else:
+                    if self.spooled > 0:
+                        self.clearSpool()
+                    logging.info(f'Flushed {len(batch) - len(dead)} documents to MongoDB')
+            except Exception as e:
+                # The spool file could not be read or written, keep the documents in memory for the next flush
+                logging.error(f'Error with the write-behind spool, keeping {len(pending)} documents in memory: \n{e}')
+                with self.condition:
+                    self.buffer = pending + self.buffer
+            finally:
+                with self.condition:
+                    self.inflight = []
+
+    def write(self, batch):
+        """
+        Insert the batch and return the documents to retry and the ones that can never be written, with their error
+        """
+        from bson.errors import InvalidDocument
+        from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+        db = self.client.get_database(name='InsightsAutomation')
+        collections = {}
+        for collection, document in batch:
+            collections.setdefault(collection, []).append(document)
+
+        retry = []
+        dead = []
+        for collection, documents in collections.items():
+            try:
+                db.get_collection(collection).insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    entry = (collection, documents[error['index']])
+                    if error.get('code') == 11000:
+                        # Written by an earlier, partially failed flush
+                        continue
+                    elif error.get('code') in self.RETRYABLE_CODES:
+                        retry.append(entry)
+                    else:
+                        dead.append((entry, error.get('errmsg')))
+            except (InvalidDocument, PyMongoError) as e:
+                if self.isRetryable(e):
+                    retry += [(collection, document) for document in documents]
+                    continue
+
+                # The whole insert was rejected, e.g. for a document over the size limit, so find the documents at fault
+                for document in documents:
+                    try:
+                        db.get_collection(collection).insert_one(document)
+                    except DuplicateKeyError:
+                        continue
+                    except (InvalidDocument, PyMongoError) as error:
+                        if self.isRetryable(error):
+                            retry.append((collection, document))
+                        else:
+                            dead.append(((collection, document), str(error)))
+
+        return retry, dead
+
+    def isRetryable(self, error):
+        from pymongo.errors import ConnectionFailure, OperationFailure
+        if isinstance(error, ConnectionFailure):
+            return True
+        return isinstance(error, OperationFailure) and (error.code in self.RETRYABLE_CODES or error.has_error_label('RetryableWriteError'))
+
+    def countSpooled(self):
+        if not os.path.exists(self.spool_path):
+            return 0
+        with open(self.spool_path, 'r', encoding='utf-8') as spool:
+            return sum(1 for line in spool if line.strip())
+
+    def readSpool(self, quarantine=True):
+        batch = []
+        lines = []
+        corrupt_lines = []
+        with open(self.spool_path, 'r', encoding='utf-8') as spool:
+            for line in spool:
+                if not line.strip():
+                    continue
+                try:
+                    entry = self.json_util.loads(line)
+                    batch.append((entry['collection'], entry['document']))
+                    lines.append(line)
+                except (ValueError, KeyError) as e:
+                    if quarantine:
+                        logging.error(f'Corrupt line in the write-behind spool, moving it to {self.spool_path}.corrupt: {e}')
+                        corrupt_lines.append(line)
+
+        if len(corrupt_lines) > 0:
+            # Set corrupt lines aside rather than failing every flush on them
+            self.appendLines(f'{self.spool_path}.corrupt', corrupt_lines)
+            self.replaceSpoolLines(lines)
+        return batch
+
+    def replaceSpool(self, batch):
+        self.replaceSpoolLines([self.json_util.dumps({'collection': collection, 'document': document}) + '\n' for collection, document in batch])
+
+    def replaceSpoolLines(self, lines):
+        # Write a new spool file and swap it in, so a crash leaves either the old or the new one
+        path = f'{self.spool_path}.tmp'
+        with open(path, 'w', encoding='utf-8') as spool:
+            spool.writelines(lines)
+            spool.flush()
+            os.fsync(spool.fileno())
+        os.replace(path, self.spool_path)
+        self.spooled = len(lines)
+
+    def writeDeadLetters(self, dead):
+        """
+        Move documents that MongoDB will never accept to the dead letter file, so they don't block the spool
+        """
+        logging.error(f'Could not write {len(dead)} documents to MongoDB, moving them to {self.spool_path}.dead: {[error for entry, error in dead]}')
+        self.appendLines(f'{self.spool_path}.dead', [self.json_util.dumps({'collection': collection, 'document': document, 'error': error}) + '\n' for (collection, document), error in dead])
+        self.dead_letters += len(dead)
+
+    def appendLines(self, path, lines):
+        with open(path, 'a', encoding='utf-8') as output:
+            output.writelines(lines)
+            output.flush()
+            os.fsync(output.fileno())
+
+    def clearSpool(self):
+        if os.path.exists(self.spool_path):
+            os.remove(self.spool_path)
+        self.spooled = 0
+
+    def close(self):
+        self.flush()
+
+    def getStats(self):
+        with self.condition:
+            buffered = len(self.buffer)
+        flush_seconds = sorted(self.flush_seconds)
+
+        return {
+            'queueDepth': buffered + self.spooled,
+            'buffered': buffered,
+            'spooled': self.spooled,
+            'flushed': self.flushed,
+            'failedFlushes': self.failed_flushes,
+            'deadLetters': self.dead_letters,
+            'flushAvg': round(sum(flush_seconds) / len(flush_seconds), 3) if flush_seconds else None,
+            'flushP95': flush_seconds[min(len(flush_seconds) - 1, int(0.95 * len(flush_seconds)))] if flush_seconds else None
+        }
@@ -0,0 +1,42 @@
+import logging
+import threading
+
+class FeedState():
+    """
+    Remembers the validators and the newest item timestamp of each polled folder
+    """
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def get(self, mongo, source, userId, folderId):
+        key = (source, userId, folderId)
+        with self.lock:
+            state = self.states.get(key)
+
+        if state is None and mongo is not None:
+            try:
+                state = mongo.findFeedState(source=source, userId=userId, folderId=folderId)
+            except Exception as e:
+                logging.warning(f'Could not load the {source} poll state of folder {folderId}: {e}')
+
+        return dict(state or {})
+
+    def save(self, mongo, source, userId, folderId, state):
+        key = (source, userId, folderId)
+        with self.lock:
+            self.states[key] = dict(state)
+
+        if mongo is not None:
+            try:
+                mongo.saveFeedState(source=source, userId=userId, folderId=folderId, state=state)
+            except Exception as e:
+                logging.warning(f'Could not save the {source} poll state of folder {folderId}: {e}')
+
+    def conditionalHeaders(self, state):
+        headers = {}
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('lastModified'):
+            headers['If-Modified-Since'] = state['lastModified']
+        return headers
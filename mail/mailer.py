@@ -0,0 +1,133 @@
+import logging
+import smtplib
+import threading
+import queue
+
+class Mailer():
+    """
+    Delivers emails over one authenticated SMTP connection per run
+    """
+    def __init__(self, username, password, recipient, host='smtp.gmail.com', port=587, digest=False, background=False):
+        self.username = username
+        self.password = password
+        self.recipient = recipient
+        self.host = host
+        self.port = port
+        self.digest = digest
+        self.sections = []
+        self.digest_callbacks = []
+        self.smtp_server = None
+        self.lock = threading.Lock()
+        self.queue = None
+
+        if background:
+            self.queue = queue.Queue()
+            self.worker = threading.Thread(target=self.processQueue, daemon=True)
+            self.worker.start()
+
+    def connect(self):
+        logging.info(f'Connecting to SMTP server {self.host}:{self.port}...')
+        smtp_server = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            smtp_server.ehlo()
+            smtp_server.starttls()
+            smtp_server.login(self.username, self.password) # https://support.google.com/accounts/answer/185833
+        except Exception:
+            smtp_server.close()
+            raise
+        self.smtp_server = smtp_server
+
+    def disconnect(self):
+        if self.smtp_server is not None:
+            try:
+                self.smtp_server.quit()
+            except OSError as e:
+                # smtplib errors are OSErrors too
+                logging.warning(f'Error closing SMTP connection: {e}')
+            finally:
+                self.smtp_server.close()
+                self.smtp_server = None
+
+    def send(self, subject, body, urls, onDelivered=None):
+        """
+        Send the email, add it to the digest or queue it for background delivery.
+        Returns whether it was delivered, or None when delivery is pending, and calls onDelivered once it is delivered
+        """
+        if self.digest:
+            self.sections.append(f'{subject}\n\n{urls}\n\n{body}')
+            self.digest_callbacks.append(onDelivered)
+            return None
+        elif self.queue is not None:
+            self.queue.put((subject, body, urls, onDelivered))
+            return None
+        else:
+            return self.deliverAndNotify(subject, body, urls, onDelivered)
+
+    def deliverAndNotify(self, subject, body, urls, onDelivered):
+        delivered = self.deliver(subject, body, urls)
+        if delivered and onDelivered is not None:
+            onDelivered()
+        return delivered
+
+    def deliver(self, subject, body, urls):
+        msg = f'Subject: {subject}\n\n{urls}\n\n{body}'
+
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.smtp_server is None:
+                        self.connect()
+
+                    logging.info(f'Sending email...')
+                    self.smtp_server.sendmail(self.username, self.recipient, msg.encode('utf-8'))
+                    logging.info('Email sent!')
+                    return True
+                except smtplib.SMTPServerDisconnected as e:
+                    # Close the broken connection and reconnect once
+                    logging.warning(f'SMTP connection lost on attempt {attempt + 1}: {e}')
+                    self.disconnect()
+                except smtplib.SMTPException as e:
+                    # Authentication, refused recipients and other SMTP errors would fail again on a new connection
+                    logging.error(f'Error sending email: \n{e}')
+                    return False
+                except OSError as e:
+                    logging.warning(f'SMTP connection lost on attempt {attempt + 1}: {e}')
+                    self.disconnect()
+
+        logging.error(f'Error sending email: could not reconnect to {self.host}')
+        return False
+
+    def processQueue(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                subject, body, urls, onDelivered = item
+                self.deliverAndNotify(subject, body, urls, onDelivered)
+            except Exception as e:
+                logging.error(f'Error delivering queued email: \n{e}')
+            finally:
+                self.queue.task_done()
+
+    def close(self, digest_subject='Insights digest'):
+        """
+        Send the digest if any, wait for queued emails and close the connection
+        """
+        if self.digest and len(self.sections) > 0:
+            body = '\n\n========================================\n\n'.join(self.sections)
+            callbacks = [callback for callback in self.digest_callbacks if callback is not None]
+            self.sections = []
+            self.digest_callbacks = []
+            self.digest = False
+            self.send(digest_subject, body, '', onDelivered=lambda: [callback() for callback in callbacks])
+
+        if self.queue is not None:
+            # Wait for the queued emails, then stop the worker
+            self.queue.join()
+            self.queue.put(None)
+            self.worker.join()
+            self.queue = None
+
+        with self.lock:
+            self.disconnect()
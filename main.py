@@ -1,31 +1,50 @@
 import os
 from dotenv import load_dotenv
 import requests
-from bs4 import BeautifulSoup
 # from newspaper import Article
 import json
 import time
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
 from datetime import datetime, timedelta
-import openai
-import smtplib
-import tiktoken
 import sys
 import logging
 import re
+# Heavy dependencies (selenium, bs4, tiktoken, openai, numpy, smtplib, pymongo) are imported on first use to keep cold starts fast
 from database.mongodb import MongoDB
+from scraping.downloader import ArticleDownloader
+from cache.config_cache import ConfigCache
+from feeds.polling import FeedState
+from prompts.templates import getTemplate, articlePayload, PromptUsage
 
 class Main():
+  # Shared across requests so connections to article sites are pooled
+  downloader = ArticleDownloader()
+  # Shared across requests so configs and sessions are not rebuilt on every call
+  config_cache = ConfigCache()
+  # Shared across requests so scheduled runs only analyse what is new
+  feed_state = FeedState()
+  # Shared across requests to report the prompt tokens served from the provider's cache
+  prompt_usage = PromptUsage()
+  # Loaded on first use or by prewarm
+  encoder = None
+
   def __init__(self):
     logging.basicConfig(level=logging.INFO)
 
     self.MONGODB_USERID = os.getenv('MONGODB_USERID')
+    self.USER_ID = self.MONGODB_USERID
+    self.feed_unchanged = False
+    self.pending_feed_state = None
     self.FEEDLY_API_URL = os.getenv('FEEDLY_API_URL', 'https://cloud.feedly.com')
     self.INOREADER_API_URL = os.getenv('INOREADER_API_URL', 'https://www.inoreader.com/reader/api/0')
     self.MODEL = 'chatgpt-4o-latest'
     self.MAX_TOKENS = 128000
+    self.RANKING_TOPICS = os.getenv('RANKING_TOPICS', '')
+    self.RANKING_TOP_K = None
+    self.RANKING_FETCH_FACTOR = 3
+    self.RANKING_TOKEN_BUDGET = 100000
+    self.PROMPTS = {}
+    self.DEFERRED = os.getenv('LLM_DEFERRED', 'false').lower() == 'true'
+    self.deferred_prompts = []
 
   def getLocalConfig(self, setupClients):
     # Load environment variables
@@ -48,29 +67,61 @@ class Main():
 
   def getConfig(self, userId):
     logging.info(f'Get config for user {userId}')
+    self.USER_ID = userId
     self.mongo = MongoDB()
+    self.config_cache.watch(self.mongo)
+
+    # Without the change stream, a projected read of the version tells whether the cached config is stale
+    cached = self.config_cache.get(userId, loadVersion=lambda: self.mongo.findConfigVersion(userId=userId))
+    if cached is not None:
+      logging.info(f'Using cached config for user {userId}')
+      self.applyConfig(cached['config'])
+      self.feedly = cached['clients']['feedly']
+      self.inoreader = cached['clients']['inoreader']
+      import openai
+      openai.api_key = self.OPENAI_API_KEY
+      return True
+
+    start = time.monotonic()
     config = self.mongo.findConfigForUser(userId=userId)
     if config is not None:
-      self.FEEDLY_USER_ID = config['feedly']['user']
-      self.FEEDLY_ACCESS_TOKEN = config['feedly']['accessToken']
-      self.FEEDLY_FOLDERS_LIST = str(config['feedly']['folders']).split(', ')
-
-      self.INOREADER_APP_ID = str(config['inoreader']['appId'])
-      self.INOREADER_APP_KEY = str(config['inoreader']['appKey'])
-      self.INOREADER_ACCESS_TOKEN = str(config['inoreader']['accessToken'])
-      self.INOREADER_FOLDERS_LIST = str(config['inoreader']['folders']).split(', ')
-      
-      self.OPENAI_API_KEY = config['openai']['apiKey']
-
-      self.EMAIL_USERNAME = config['google']['emailUsername']
-      self.EMAIL_PASSWORD = config['google']['emailPassword']
-      self.EMAIL_RECIPIENT = config['google']['emailRecipient']
-
+      self.applyConfig(config)
       self.setupClients()
+
+      clients = {
+        'feedly': self.feedly,
+        'inoreader': self.inoreader
+      }
+      self.config_cache.put(userId, config, clients, load_seconds=round(time.monotonic() - start, 3))
       return True
     else:
       return False
 
+  def applyConfig(self, config):
+    self.FEEDLY_USER_ID = config['feedly']['user']
+    self.FEEDLY_ACCESS_TOKEN = config['feedly']['accessToken']
+    self.FEEDLY_FOLDERS_LIST = str(config['feedly']['folders']).split(', ')
+
+    self.INOREADER_APP_ID = str(config['inoreader']['appId'])
+    self.INOREADER_APP_KEY = str(config['inoreader']['appKey'])
+    self.INOREADER_ACCESS_TOKEN = str(config['inoreader']['accessToken'])
+    self.INOREADER_FOLDERS_LIST = str(config['inoreader']['folders']).split(', ')
+    
+    self.OPENAI_API_KEY = config['openai']['apiKey']
+
+    self.EMAIL_USERNAME = config['google']['emailUsername']
+    self.EMAIL_PASSWORD = config['google']['emailPassword']
+    self.EMAIL_RECIPIENT = config['google']['emailRecipient']
+
+    ranking = config.get('ranking', {})
+    topics = ranking.get('topics', self.RANKING_TOPICS)
+    self.RANKING_TOPICS = ', '.join(topics) if isinstance(topics, list) else str(topics)
+    self.RANKING_TOP_K = int(ranking['topK']) if ranking.get('topK') is not None else self.RANKING_TOP_K
+    self.RANKING_FETCH_FACTOR = int(ranking.get('fetchFactor', self.RANKING_FETCH_FACTOR))
+    self.RANKING_TOKEN_BUDGET = int(ranking.get('tokenBudget', self.RANKING_TOKEN_BUDGET))
+
+    self.PROMPTS = config.get('prompts', {})
+
   def setupClients(self):
     # Setup clients
     logging.info('Setting up the API clients...')
@@ -81,9 +132,10 @@ class Main():
     self.inoreader.headers = {
       'AppId': self.INOREADER_APP_ID,
       'AppKey': self.INOREADER_APP_KEY,
-      'Authorization': f'GoogleLogin auth= {self.inoReaderClientLogin()}'
+      'Authorization': f'GoogleLogin auth={self.inoReaderClientLogin()}'
     }
 
+    import openai
     openai.api_key = self.OPENAI_API_KEY
 
   def inoReaderClientLogin(self):
@@ -99,14 +151,92 @@ class Main():
     self.INOREADER_AUTH_CODE = re.search(r'Auth=([^;]+)', auth_request.text)[1].strip()
     return self.INOREADER_AUTH_CODE
   
+  @classmethod
+  def getEncoder(cls):
+    if cls.encoder is None:
+      import tiktoken
+      cls.encoder = tiktoken.get_encoding("cl100k_base")
+    return cls.encoder
+
+  @classmethod
+  def prewarm(cls):
+    """
+    Load the heavy dependencies and the token encoder ahead of the first request
+    """
+    start = time.monotonic()
+    try:
+      cls.getEncoder()
+      import openai
+      import numpy
+      import pymongo
+      from bs4 import BeautifulSoup
+      logging.info(f'Prewarmed dependencies in {round(time.monotonic() - start, 3)}s')
+    except Exception as e:
+      logging.warning(f'Could not prewarm dependencies: {e}')
+
   def count_tokens(self, text):
-      enc = tiktoken.get_encoding("cl100k_base")
+      enc = self.getEncoder()
       token_count = enc.encode(text)
       
       return len(token_count)
 
+  def selectArticles(self, indices):
+    self.urls = [self.urls[i] for i in indices]
+    self.titles = [self.titles[i] for i in indices]
+    self.summaries = [self.summaries[i] for i in indices]
+    self.contents = [self.contents[i] for i in indices]
+    self.article_count = len(indices)
+
+  def rankArticles(self, top_k=None):
+    """
+    Order the fetched articles by relevance to the user's topic profile and keep the top K
+    """
+    if self.RANKING_TOPICS:
+      documents = [f'{title} {summary} {content}' for title, summary, content in zip(self.titles, self.summaries, self.contents)]
+      from ranking.relevance import RelevanceRanker
+      order = RelevanceRanker().rank(documents, self.RANKING_TOPICS, top_k)
+    else:
+      order = list(range(len(self.urls)))[:top_k]
+
+    self.selectArticles(order)
+
+  def fitTokenBudget(self):
+    """
+    Keep the highest ranked articles that fit in the token budget of the prompt
+    """
+    selected = []
+    used_tokens = 0
+    for index, (url, title, summary, content) in enumerate(zip(self.urls, self.titles, self.summaries, self.contents)):
+      tokens = self.count_tokens(f'\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n')
+      if used_tokens + tokens <= self.RANKING_TOKEN_BUDGET:
+        selected.append(index)
+        used_tokens += tokens
+
+    if len(selected) == 0 and len(self.urls) > 0:
+      # Not even the top article fits, so keep it truncated to the budget
+      self.summaries[0], self.contents[0] = self.truncateArticle(self.urls[0], self.titles[0], self.summaries[0], self.contents[0])
+      selected = [0]
+
+    if len(selected) < len(self.urls):
+      logging.info(f'Kept {len(selected)} of {len(self.urls)} articles within the token budget of {self.RANKING_TOKEN_BUDGET}.')
+    self.selectArticles(selected)
+
+  def truncateArticle(self, url, title, summary, content):
+    """
+    Cut the summary and then the content of the article so its prompt fits in the token budget
+    """
+    enc = self.getEncoder()
+    remaining = self.RANKING_TOKEN_BUDGET - self.count_tokens(f'\nURL: {url}\nTitle: {title}\nSummary: \nContent: \n')
+    summary_tokens = enc.encode(summary)[:max(remaining, 0)]
+    remaining -= len(summary_tokens)
+    content_tokens = enc.encode(content)[:max(remaining, 0)]
+    logging.info(f'Truncated article {url} to the token budget of {self.RANKING_TOKEN_BUDGET}.')
+
+    return enc.decode(summary_tokens), enc.decode(content_tokens)
+
   def callOpenAIChat(self, role, prompt):
     logging.info('Connecting to ChatGPT to generate content...')
+    import openai
     response = openai.ChatCompletion.create(
       model=self.MODEL, 
       temperature=0.2,
@@ -116,10 +246,58 @@ class Main():
         {'role': 'user', 'content': prompt}
       ]
     )
+    cached_tokens = self.prompt_usage.record(response.get('usage'))
+    logging.info(f'Prompt used {response.get("usage", {}).get("prompt_tokens")} tokens, {cached_tokens} of them cached.')
     return response['choices'][0]['message']['content']
 
+  def chatOrDefer(self, role, prompt, deliver, **context):
+    """
+    Generate the content now, or collect the prompt for the batch submitted at the end of a deferred run
+    """
+    if self.DEFERRED:
+      self.deferred_prompts.append((role, prompt, deliver, context))
+    else:
+      deliver(self.callOpenAIChat(role, prompt), **context)
+
+  def submitDeferred(self):
+    """
+    Submit the prompts collected during the run as one batch, wait for it and deliver the results
+    """
+    if len(self.deferred_prompts) == 0:
+      return
+
+    from batch.openai_batch import BatchClient
+    prompts = [(f'request-{index}', role, prompt) for index, (role, prompt, deliver, context) in enumerate(self.deferred_prompts)]
+    results = BatchClient(api_key=self.OPENAI_API_KEY, model=self.MODEL).run(prompts)
+
+    for index, (role, prompt, deliver, context) in enumerate(self.deferred_prompts):
+      result = results.get(f'request-{index}')
+      if result is None:
+        logging.error(f'No batch result for folder {context.get("folder_id")}, it will be analysed again in the next run.')
+        continue
+
+      self.prompt_usage.record(result.get('usage'))
+      deliver(result['choices'][0]['message']['content'], **context)
+
+    self.deferred_prompts = []
+
+  def deliverInsights(self, insights, source, folder_id, count, urls, feed_state):
+    # Deferred results arrive long after the run started, so keep them in the history as well as emailing them
+    if self.DEFERRED and getattr(self, 'mongo', None) is not None:
+      self.mongo.insertInsights(userId=self.USER_ID, insights=insights, urls=urls)
+
+    self.sendEmail(subject=f'{source} Insights from {count} articles for folder {folder_id}', body=insights, urls=urls, onDelivered=lambda: self.commitFeedState(feed_state))
+
+  def buildPrompt(self, name, payload, count, role=None, instructions=None):
+    """
+    Render the user's template: static role and instructions first, the payload last
+    """
+    template = getTemplate(name, overrides=self.PROMPTS, role=role, instructions=instructions)
+    return template.role, template.render(payload, count=count)
+
   def callOpenAIImage(self, prompt):
     logging.info('Connecting to ChatGPT to generate an image...')
+    import openai
     response = openai.Image.create(
       model="dall-e-3",
       prompt=prompt,
@@ -140,17 +318,13 @@ class Main():
 
         if articles:
           logging.info(f'Generating insights from articles in Feedly folder: {folder_id}')
-          article_prompts = [f'\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n' for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents)]
-          
-          role = 'You are a research analyst.'
-          prompt = f'Extract the key insights & trends in UK English from these {self.article_count} articles and highlight any resources worth checking. For each key insight, mention the source article:\n'
-          for article_prompt in article_prompts:
-            prompt += article_prompt
+          role, prompt = self.buildPrompt('feedlyInsights', articlePayload(self.urls, self.titles, self.summaries, self.contents), count=self.article_count)
           insights = self.callOpenAIChat(role, prompt)
 
           self.mongo = MongoDB()
-          if self.mongo.insertInsights(userId=userId, insights=insights, urls=self.urls):
-            return [insights, self.urls]
+          insightId = self.mongo.insertInsights(userId=userId, insights=insights, urls=self.urls)
+          if insightId:
+            return [insights, self.urls, insightId]
           else:
             return "insights-failed"
         else:
@@ -166,17 +340,13 @@ class Main():
         if articles:
           if articles:
             logging.info(f'Generating insights from articles in Inoreader folder: {folder_id}')
-            article_prompts = [f'\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n' for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents)]
-            
-            role = 'You are a board avisor specialising in AI sustainability.'
-            prompt = f'Extract the key insights & trends, as well as a summary of each article, in UK English from these {self.article_count} articles by accessing the articles from the URLs. For each key insight, list the source article including the title and the URL:\n'
-            for article_prompt in article_prompts:
-              prompt += article_prompt
+            role, prompt = self.buildPrompt('inoreaderInsights', articlePayload(self.urls, self.titles, self.summaries, self.contents), count=self.article_count)
             insights = self.callOpenAIChat(role, prompt)
 
             self.mongo = MongoDB()
-            if self.mongo.insertInsights(userId=userId, insights=insights, urls=self.urls):
-              return [insights, self.urls]
+            insightId = self.mongo.insertInsights(userId=userId, insights=insights, urls=self.urls)
+            if insightId:
+              return [insights, self.urls, insightId]
             else:
               return "insights-failed"
         else:
@@ -188,42 +358,42 @@ class Main():
     """
     Generate insights from the Feedly articles
     """
-    for folder_id in self.FEEDLY_FOLDERS_LIST:
-      articles = self.getFeedlyArticles(folder_id=folder_id, daysdelta=1)
+    # The folders, OpenAI key and email settings come from the config of the scheduled user
+    if self.getConfig(self.MONGODB_USERID):
+      unchanged_folders = []
+      for folder_id in self.FEEDLY_FOLDERS_LIST:
+        articles = self.getFeedlyArticles(folder_id=folder_id, daysdelta=1, poll='insights')
 
-      if articles:
-        logging.info(f'Generating insights from articles in Feedly folder: {folder_id}')
-        article_prompts = [f'URL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n' for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents)]
-        
-        role = 'You are a research analyst writing in UK English.'
-        prompt = f'Extract the key insights & trends from these {self.article_count} articles and highlight any resources worth checking. For each key insight, mention the source article:\n'
-        for article_prompt in article_prompts:
-          prompt += article_prompt
+        if articles:
+          logging.info(f'Generating insights from articles in Feedly folder: {folder_id}')
+          role, prompt = self.buildPrompt('feedlyInsights', articlePayload(self.urls, self.titles, self.summaries, self.contents), count=self.article_count)
 
-        insights = self.callOpenAIChat(role, prompt)
+          self.chatOrDefer(role, prompt, self.deliverInsights, source='Feedly', folder_id=folder_id, count=self.article_count, urls=self.urls, feed_state=self.takeFeedState())
+        elif self.feed_unchanged:
+          unchanged_folders.append(folder_id)
 
-      self.sendEmail(subject=f'Feedly Insights from {self.article_count} articles for folder {folder_id}', body=insights, urls=self.urls)
+      return self.pollSummary('Feedly', unchanged_folders, self.FEEDLY_FOLDERS_LIST)
+    else:
+      return 'Could not load configuration from MongoDB'
 
   def emailInoreaderInsights(self):
     """
     Generate insights from the Inoreader articles
     """
     if self.getConfig(self.MONGODB_USERID):
+      unchanged_folders = []
       for folder_id in self.INOREADER_FOLDERS_LIST:
-        articles = self.getInoreaderArticles(folder_id=folder_id, numarticles=3)
+        articles = self.getInoreaderArticles(folder_id=folder_id, numarticles=3, poll='insights')
 
         if articles:
           logging.info(f'Generating insights from articles in Inoreader folder: {folder_id}')
-          article_prompts = [f'URL: {url}\nTitle: {title}\nSummary: {summary}\Content: {content}\n' for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents)]
-          
-          role = 'You are a board avisor specialising in AI sustainability.'
-          prompt = f'Extract the key insights & trends, as well as a summary of each article, in UK English from these {self.article_count} articles. For each key insight, list the source article including the title and the URL:\n'
-          for article_prompt in article_prompts:
-            prompt += article_prompt
+          role, prompt = self.buildPrompt('inoreaderInsights', articlePayload(self.urls, self.titles, self.summaries, self.contents), count=self.article_count)
 
-          insights = self.callOpenAIChat(role, prompt)
+          self.chatOrDefer(role, prompt, self.deliverInsights, source='Inoreader', folder_id=folder_id, count=self.article_count, urls=self.urls, feed_state=self.takeFeedState())
+        elif self.feed_unchanged:
+          unchanged_folders.append(folder_id)
 
-        self.sendEmail(subject=f'Inoreader Insights from {self.article_count} articles for folder {folder_id}', body=insights, urls=self.urls)
+      return self.pollSummary('Inoreader', unchanged_folders, self.INOREADER_FOLDERS_LIST)
     else:
       return 'Could not load configuration from MongoDB'
   
@@ -246,55 +416,24 @@ class Main():
           if insight is not None:
             insights.append(insight['insights'])
             urls.append(insight['urls'])
-
-            logging.info(f'Generating LinkedIn post from insights')
             self.urls = insight["urls"]
-            role = prompt_role
-            if post_prompt != '':
-              prompt = f'{post_prompt} \n{insights} \n{urls}'
-            else:
-              prompt = f'\nContext: My mission is to guide startups in the AI and sustainability space to build products that have a positive impact on the planet and the environment.'
-              prompt += f'As a board advisor I want to make sure that every decision made considers the UN sustainable development goals and the impact our actions have.'
-              prompt += f'\nThe post must be written from the voice of the board advisor.'
-              prompt += f'\nDo not use the context in the post. It\'s for your information only.'
-              prompt += f'\nYou should only talk about the insights and trends extracted from these articles with a bias towards process automation.'
-              prompt += f'\nWord the insights as if I was commenting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.'
-              prompt += f'\nThe post must be written in UK English, focused on the key insights around AI and sustainability, and sound professional but not formal.'
-              prompt += f'\nMention that the links are in the first comment.'
-              prompt += f'\nFinish with a call to action asking readers to comment on my posts.'
-              prompt += f'\nAll posts must include this at the bottom: Image source: DALL-E 3, as well as some hashtags related to the insights.'
-              prompt += f'\nYou are tasked with generating a LinkedIn post including the links to the relevant articles from these insights: {insights}, generated from these URLs: {urls}'
+
+        if len(insights) > 0:
+          logging.info(f'Generating LinkedIn post from insights')
+          role, prompt = self.buildPrompt('insightsLinkedInPost', [f'\nInsights: {insights}', f'\nURLs: {urls}'], count=len(insights), role=prompt_role, instructions=post_prompt)
       else:
         articles = self.getInoreaderArticles(folder_id=self.INOREADER_FOLDERS_LIST[0], numarticles=numarticles)
         if articles:
           logging.info(f'Generating LinkedIn post from Inoreader articles in folder: {self.INOREADER_FOLDERS_LIST[0]}')
           urls = self.urls
-          role = prompt_role
-
-          if post_prompt != '':
-              prompt = post_prompt
-              for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents):
-                prompt += f'\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n'
-          else:
-            prompt = f'\nContext: My mission is to guide startups in the AI and sustainability space to build products that have a positive impact on the planet and the environment.'
-            prompt += f'As a board advisor I want to make sure that every decision made considers the UN sustainable development goals and the impact our actions have.'
-            prompt += f'\nThe post must be written from the voice of the board advisor.'
-            prompt += f'\nDo not use the context in the post. It\'s for your information only.'
-            prompt += f'\nYou should only talk about the insights and trends extracted from these articles with a bias towards process automation.'
-            prompt += f'\nWord the insights as if I was commenting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.'
-            prompt += f'\nThe post must be written in UK English, focused on the key insights around AI and sustainability, and sound professional but not formal.'
-            prompt += f'\nMention that the links are in the first comment.'
-            prompt += f'\nFinish with a call to action asking readers to comment on my posts.'
-            prompt += f'\nAll posts must include this at the bottom: Image source: DALL-E 3, as well as some hashtags related to the insights.'          
-            prompt += f'\nYou are tasked with extracting insights and generate a LinkedIn post including the links to the relevant articles from these {self.article_count} articles:'
-            for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents):
-              prompt += f'\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n'
+          role, prompt = self.buildPrompt('inoreaderLinkedInPost', articlePayload(self.urls, self.titles, self.summaries, self.contents), count=self.article_count, role=prompt_role, instructions=post_prompt)
 
       if prompt is not None:
         post = self.callOpenAIChat(role, prompt)
         image = self.callOpenAIImage(f'{image_prompt} {post}')
-        if self.mongo.insertPost(userId=userId, insightIds=insightIds, post=post, image=image, urls=urls):
-          return [post, urls, image]
+        postId = self.mongo.insertPost(userId=userId, insightIds=insightIds, post=post, image=image, urls=urls)
+        if postId:
+          return [post, urls, image, postId]
         else:
           return "post-failed"
       else:
@@ -302,37 +441,34 @@ class Main():
     else: 
       return "no-config-found"
 
+  def findHistory(self, collection, userId, limit, after, fields):
+    """
+    Get a page of the stored insights or LinkedIn posts of the user
+    """
+    self.mongo = MongoDB()
+    return self.mongo.findHistory(collection=collection, userId=userId, limit=limit, after=after, fields=fields)
+
   def emailFeedlyLinkedInPost(self):
     """
     Generate a LinkedIn post from the articles
     """
+    unchanged_folders = []
     for folder_id in self.FEEDLY_FOLDERS_LIST:
-      articles = self.getFeedlyArticles(folder_id=folder_id, daysdelta=2)
+      articles = self.getFeedlyArticles(folder_id=folder_id, daysdelta=2, poll='linkedinpost')
 
       if articles:
         logging.info(f'Generating LinkedIn post from articles in folder: {folder_id}')
-        role = 'You are a marketing manager working for a consultancy called ProfessionalPulse.'
-        prompt = f'Imagine that you are a marketing manager for a consultancy called ProfessionalPulse.'
-        prompt += f'\nContext: At ProfessionalPulse, we\'re passionate about leveraging technology to transform the operations of Business Services teams within Professional Services Firms.'
-        prompt += f'Our journey began in the dynamic realm of IT and consultancy, and was inspired by real-life challenges faced by these teams.'
-        prompt += f'Today, we use our expertise and unique approach to help these teams navigate their challenges, boost efficiency, and strike a balance between their professional and personal lives.'
-        prompt += f'Discover more about our ethos, our journey, and how we can help you.'
-        prompt += f'\nYou are tasked with extracting insights and generate a LinkedIn post including the links to the relevant articles from these {self.article_count} articles:'
-        for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents):
-          prompt += f'\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n'
-        prompt += f'\nDo not use the context in the post. It\'s for your information only.'
-        prompt += f'\nYou should only talk about the insights extracted from these articles with a bias towards process automation, and the links to the articles should be neatly listed at the very end of the post, after everything else.'
-        prompt += f'\nUse numbers for each insight to point to the relevant article URL.'
-        prompt += f'\nWord the insights as if I was commeting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.'
-        prompt += f'\nThe post must be written in UK English, focused on the key insights around AI and technology, and sound professional as the target audience are professionals.'
-        prompt += f'\nMention that the links are in the first comment and add the links at the bottom, listed by the number of the insight they belong to.'
-        prompt += f'\nFinish with a call to action asking readers to message me on LinkedIn if they are interested in discussing either the insights or how I could help them.'
-        prompt += f'\nAll posts must include this at the bottom: Image source: DALL-E 3'
+        role, prompt = self.buildPrompt('feedlyLinkedInPost', articlePayload(self.urls, self.titles, self.summaries, self.contents), count=self.article_count)
 
         post = self.callOpenAIChat(role, prompt)
         image = self.callOpenAIImage(f'Generate an image based on the following LinkedIn post: \n{post}')
         body = post + f'\n\nImage URL: {image}'
-        self.sendEmail(subject=f'LinkedIn post from {self.article_count} articles for folder {folder_id}', body=body, urls=self.urls)
+        feed_state = self.takeFeedState()
+        self.sendEmail(subject=f'LinkedIn post from {self.article_count} articles for folder {folder_id}', body=body, urls=self.urls, onDelivered=lambda feed_state=feed_state: self.commitFeedState(feed_state))
+      elif self.feed_unchanged:
+        unchanged_folders.append(folder_id)
+
+    return self.pollSummary('Feedly', unchanged_folders, self.FEEDLY_FOLDERS_LIST)
 
   def emailInoreaderLinkedInPost(self):
     """
@@ -340,50 +476,48 @@ class Main():
     """
     self.getConfig(self.MONGODB_USERID)
 
+    unchanged_folders = []
     for folder_id in self.INOREADER_FOLDERS_LIST:
-      articles = self.getInoreaderArticles(folder_id=folder_id, numarticles=3)
+      articles = self.getInoreaderArticles(folder_id=folder_id, numarticles=3, poll='linkedinpost')
 
       if articles:
         logging.info(f'Generating LinkedIn post from Inoreader articles in folder: {folder_id}')
-        role = 'You are a board advisor operating as Chenot Consulting Ltd.'
-        prompt = f'\nContext: My mission is to guide startups in the AI and sustainability space to build products that have a positive impact on the planet and the environment.'
-        prompt += f'As a board advisor I want to make sure that every decision made considers the UN sustainable development goals and the impact our actions have.'
-        prompt += f'\nThe post must be written from the voice of the board advisor.'
-        prompt += f'\nDo not use the context in the post. It\'s for your information only.'
-        prompt += f'\nYou should only talk about the insights and trends extracted from these articles with a bias towards process automation.'
-        prompt += f'\nWord the insights as if I was commenting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.'
-        prompt += f'\nThe post must be written in UK English, focused on the key insights around AI and sustainability, and sound professional but not formal.'
-        prompt += f'\nMention that the links are in the first comment.'
-        prompt += f'\nFinish with a call to action asking readers to comment on my posts.'
-        prompt += f'\nAll posts must include this at the bottom: Image source: DALL-E 3, as well as some hashtags related to the insights.'          
-        prompt += f'\nYou are tasked with extracting insights and generating a LinkedIn post without icons, including the links to the relevant articles from these {self.article_count} articles:'
-        for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents):
-          prompt += f'\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n'
+        role, prompt = self.buildPrompt('inoreaderLinkedInPost', articlePayload(self.urls, self.titles, self.summaries, self.contents), count=self.article_count)
 
         post = self.callOpenAIChat(role, prompt)
         image = self.callOpenAIImage(f'Generate an image based on the following LinkedIn post. The image must have no text on it: \n{post}')
         body = post + f'\n\nImage URL: {image}'
-        self.sendEmail(subject=f'LinkedIn post from {self.article_count} articles for folder {folder_id}', body=body, urls=self.urls)
+        feed_state = self.takeFeedState()
+        self.sendEmail(subject=f'LinkedIn post from {self.article_count} articles for folder {folder_id}', body=body, urls=self.urls, onDelivered=lambda feed_state=feed_state: self.commitFeedState(feed_state))
+      elif self.feed_unchanged:
+        unchanged_folders.append(folder_id)
 
-  def sendEmail(self, subject, body, urls):
+    return self.pollSummary('Inoreader', unchanged_folders, self.INOREADER_FOLDERS_LIST)
+
+  def sendEmail(self, subject, body, urls, onDelivered=None):
     """
-    Set up SMTP server
+    Send the email through the mailer of this run. onDelivered is only called once the email is delivered,
+    which happens when the digest is sent or the background queue gets to it in those modes
     """
-    smtp_server = smtplib.SMTP('smtp.gmail.com', 587)
-    smtp_server.ehlo()
-    smtp_server.starttls()
-    smtp_server.login(self.EMAIL_USERNAME, self.EMAIL_PASSWORD) # https://support.google.com/accounts/answer/185833
-
-    # Send email 
-    logging.info(f'Sending email...')
-
-    try:
-      msg = f'Subject: {subject}\n\n{urls}\n\n{body}'
-      smtp_server.sendmail(self.EMAIL_USERNAME, self.EMAIL_RECIPIENT, msg.encode('utf-8'))
-      logging.info('Email sent!')
-      smtp_server.quit()
-    except Exception as e:
-      logging.error(f'Error sending email: \n{e}')
+    if getattr(self, 'mailer', None) is None:
+      from mail.mailer import Mailer
+      self.mailer = Mailer(
+        username=self.EMAIL_USERNAME,
+        password=self.EMAIL_PASSWORD,
+        recipient=self.EMAIL_RECIPIENT,
+        digest=os.getenv('EMAIL_DIGEST', 'false').lower() == 'true',
+        background=os.getenv('EMAIL_BACKGROUND', 'false').lower() == 'true'
+      )
+
+    return self.mailer.send(subject=subject, body=body, urls=urls, onDelivered=onDelivered)
+
+  def closeMailer(self, digest_subject='Insights digest'):
+    """
+    Send any pending digest and close the SMTP connection of this run
+    """
+    if getattr(self, 'mailer', None) is not None:
+      self.mailer.close(digest_subject=digest_subject)
+      self.mailer = None
 
   def refreshFeedlyToken(self):
     refresh_token = os.getenv('FEEDLY_REFRESH_TOKEN')
@@ -401,16 +535,25 @@ class Main():
     response = requests.post(url, data=params)
     access_token = response.json()['access_token']
 
-  def getFeedlyArticles(self, folder_id, daysdelta):
+  def getFeedlyArticles(self, folder_id, daysdelta, poll=None):
     # Get articles from last 24 hours
     timeframe = datetime.now() - timedelta(days=daysdelta)
     timestamp_ms = int(timeframe.timestamp() * 1000)
+    self.feed_unchanged = False
+
+    # When polling for a run (e.g. 'insights'), only ask for what arrived since the newest article of its last run
+    state = self.feed_state.get(getattr(self, 'mongo', None), f'feedly/{poll}', self.USER_ID, folder_id) if poll else {}
+    newer_than = max(timestamp_ms, int(state.get('newest', 0)) + 1)
 
     logging.info(f'Getting Feedly articles for folder: {folder_id}')
     # Get articles ids for this folder
-    feedly_url = f'{self.FEEDLY_API_URL}/v3/streams/ids?streamId={folder_id}&newerThan={timestamp_ms}&count=20'
+    feedly_url = f'{self.FEEDLY_API_URL}/v3/streams/ids?streamId={folder_id}&newerThan={newer_than}&count=20'
     logging.info(f'Getting articles with Feedly URL: {feedly_url}')
-    response = self.feedly.get(feedly_url)
+    response = self.feedly.get(feedly_url, headers=self.feed_state.conditionalHeaders(state))
+
+    if poll and response.status_code == 304:
+      self.noChanges('Feedly', folder_id)
+      return False
     
     if(response.status_code == 200):
       # logging.info(f'Feedly response: {json.dumps(json.loads(response.text), indent=4)}')
@@ -418,6 +561,10 @@ class Main():
       # logging.info(f'IDs: {ids}')
       logging.info(f'Retrieved {len(ids)} articles.')
 
+      if poll and len(ids) == 0:
+        self.noChanges('Feedly', folder_id)
+        return False
+
       # Get articles from the ids
       feedly_entries_url = f'{self.FEEDLY_API_URL}/v3/entries/.mget'
       entries_response = self.feedly.post(feedly_entries_url, None, ids)
@@ -432,6 +579,15 @@ class Main():
         self.summaries = [a['summary']['content'] if 'summary' in a else '' for a in articles]
         self.contents = [a['fullContent'] if 'fullContent' in a else '' for a in articles]
 
+        if poll:
+          self.pending_feed_state = (f'feedly/{poll}', folder_id, {
+            'etag': response.headers.get('ETag'),
+            'lastModified': response.headers.get('Last-Modified'),
+            'newest': max(int(a.get('crawled', 0)) for a in articles)
+          })
+
+        self.rankArticles(top_k=self.RANKING_TOP_K)
+        self.fitTokenBudget()
         return True
       else: 
         logging.info('========================================================================================')
@@ -442,23 +598,51 @@ class Main():
 
     return False
   
-  def getInoreaderArticles(self, folder_id, numarticles = 3):
+  def getInoreaderArticles(self, folder_id, numarticles = 3, poll=None):
     logging.info(f'Getting Inoreader articles for folder: {folder_id}')
+    self.feed_unchanged = False
+    state = self.feed_state.get(getattr(self, 'mongo', None), f'inoreader/{poll}', self.USER_ID, folder_id) if poll else {}
+    newest = int(state.get('newest', 0))
+
     # Get articles ids for this folder
-    inoreader_url = f'{self.INOREADER_API_URL}/stream/contents/{folder_id}?n={numarticles}'
+    # Fetch wide and rank locally so only the most relevant articles get scraped
+    fetch_size = numarticles * self.RANKING_FETCH_FACTOR if self.RANKING_TOPICS else numarticles
+    inoreader_url = f'{self.INOREADER_API_URL}/stream/contents/{folder_id}?n={fetch_size}'
+    if newest > 0:
+      # Only ask for what arrived since the newest article of the last run
+      inoreader_url += f'&ot={newest // 1000}'
     logging.info(f'Getting articles with Inoreader URL: {inoreader_url}')
-    self.inoreader.headers = {
-      'Authorization': f'GoogleLogin auth={self.inoReaderClientLogin()}',
-      'AppId': self.INOREADER_APP_ID,
-      'AppKey': self.INOREADER_APP_KEY
-    }
-    response = self.inoreader.get(inoreader_url)
+    response = self.inoreader.get(inoreader_url, headers=self.feed_state.conditionalHeaders(state))
+
+    if response.status_code == 401:
+      # The session is shared through the config cache, so only log in again when its token has expired
+      logging.info('Inoreader token expired, logging in again...')
+      self.inoreader.headers['Authorization'] = f'GoogleLogin auth={self.inoReaderClientLogin()}'
+      response = self.inoreader.get(inoreader_url, headers=self.feed_state.conditionalHeaders(state))
+
+    if poll and response.status_code == 304:
+      self.noChanges('Inoreader', folder_id)
+      return False
     
     if(response.status_code == 200):
       # logging.info(f'Inoreader response: {json.dumps(json.loads(response.text), indent=4)}')
       articles = json.loads(response.text)['items']
       # logging.info(f'articles: {articles}')
       logging.info(f'Retrieved {len(articles)} articles.')
+
+      if poll:
+        # ot has a precision of seconds, so drop the articles already seen in the last run
+        articles = [a for a in articles if int(a.get('crawlTimeMsec', 0)) > newest]
+        if len(articles) == 0:
+          self.noChanges('Inoreader', folder_id)
+          return False
+
+        self.pending_feed_state = (f'inoreader/{poll}', folder_id, {
+          'etag': response.headers.get('ETag'),
+          'lastModified': response.headers.get('Last-Modified'),
+          'newest': max(int(a.get('crawlTimeMsec', 0)) for a in articles)
+        })
+
       self.article_count = len(articles)
 
       if(self.article_count > 0):
@@ -466,8 +650,11 @@ class Main():
         self.urls = [a['canonical'][0]['href'] for a in articles]
         self.titles = [a['title'] for a in articles]
         self.summaries = [a['summary']['content'] if 'summary' in a else '' for a in articles]
-        self.contents = [self.extractArticleContent(a['canonical'][0]['href']) for a in articles]
+        self.contents = ['' for a in articles]
 
+        self.rankArticles(top_k=numarticles)
+        self.contents = [self.getArticleContent(url, title) for url, title in zip(self.urls, self.titles)]
+        self.fitTokenBudget()
         return True
       else: 
         logging.info('========================================================================================')
@@ -478,26 +665,79 @@ class Main():
 
     return False
   
+  def noChanges(self, source, folder_id):
+    self.feed_unchanged = True
+    logging.info('========================================================================================')
+    logging.info(f'No new {source} articles since the last poll of folder {folder_id}.')
+    logging.info('========================================================================================')
+
+  def takeFeedState(self):
+    """
+    Hand over the poll state of the current folder, to be committed once its results are delivered
+    """
+    pending_feed_state = self.pending_feed_state
+    self.pending_feed_state = None
+    return pending_feed_state
+
+  def commitFeedState(self, pending_feed_state):
+    """
+    Remember what was polled once the results for the folder have been delivered
+    """
+    if pending_feed_state is not None:
+      source, folder_id, state = pending_feed_state
+      self.feed_state.save(getattr(self, 'mongo', None), source, self.USER_ID, folder_id, state)
+
+  def pollSummary(self, source, unchanged_folders, folders):
+    if len(unchanged_folders) > 0:
+      logging.info(f'{len(unchanged_folders)} of {len(folders)} {source} folders had no new articles: {unchanged_folders}')
+    if len(folders) > 0 and len(unchanged_folders) == len(folders):
+      return 'no-changes'
+
+  def getArticleContent(self, url, title):
+    """
+    Get the article from the store shared by all users, scraping it only if no run has done so yet
+    """
+    if getattr(self, 'mongo', None) is None or os.getenv('ARTICLE_STORE', 'true').lower() != 'true':
+      return self.extractArticleContent(url)
+
+    from scraping.article_store import ArticleStore
+    return ArticleStore(self.mongo).getContent(url, title, extract=self.extractArticleContent, count_tokens=self.count_tokens)
+
   def extractArticleContent(self, url):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.common.by import By
+    from bs4 import BeautifulSoup
+
+    from selenium.common.exceptions import TimeoutException
+
     chrome_options = Options()
     chrome_options.add_argument("--headless")
     driver = webdriver.Chrome(options=chrome_options)
-    driver.get(url)
+    # Bound the page load by the same limits as the download so a hanging site cannot stall extraction
+    driver.set_page_load_timeout(self.downloader.connect_timeout + self.downloader.max_seconds)
+    try:
+      try:
+        driver.get(url)
+      except TimeoutException:
+        logging.warning(f'Timed out loading {url} in the browser, continuing with the current URL')
+        driver.execute_script('window.stop();')
 
-    if re.search(r'consent.google.com([^;]+)', driver.current_url):
-      driver.find_element(By.XPATH, "//button[contains(@aria-label, 'Accept all')]").click()
+      if re.search(r'consent.google.com([^;]+)', driver.current_url):
+        driver.find_element(By.XPATH, "//button[contains(@aria-label, 'Accept all')]").click()
 
-    time.sleep(2)
-    final_url = driver.current_url
-    driver.quit()
+      time.sleep(2)
+      final_url = driver.current_url
+    finally:
+      driver.quit()
 
-    article = requests.get(final_url)
+    article = self.downloader.download(final_url)
     element = ''
     content = ''
 
-    if article.status_code == 200:
+    if article is not None:
     # BEAUTIFUL SOUP METHOD
-      soup = BeautifulSoup(article.text, 'html.parser')
+      soup = BeautifulSoup(article, 'html.parser')
       content = soup.get_text()
 
     #   element = soup.find(class_=re.search(r'content([^;]+)'))
@@ -542,19 +782,29 @@ class Main():
     logging.info(f'Starting process for option: {self.args}')
     # self.getLocalConfig()
 
-    if self.args == 'Generate Feedly Insights':
-      self.emailFeedlyInsights()
-    if self.args == 'Create Feedly LinkedIn post':
-      self.emailFeedlyLinkedInPost()
-    if self.args == 'Generate Inoreader Insights':
-      self.emailInoreaderInsights()
-    if self.args == 'Create Inoreader LinkedIn post':
-      self.emailInoreaderLinkedInPost()
-    if self.args == 'Test Inoreader Client Login':
-      self.inoReaderClientLogin()
+    try:
+      if self.args == 'Generate Feedly Insights':
+        self.emailFeedlyInsights()
+      if self.args == 'Create Feedly LinkedIn post':
+        self.emailFeedlyLinkedInPost()
+      if self.args == 'Generate Inoreader Insights':
+        self.emailInoreaderInsights()
+      if self.args == 'Create Inoreader LinkedIn post':
+        self.emailInoreaderLinkedInPost()
+      if self.args == 'Test Inoreader Client Login':
+        self.inoReaderClientLogin()
+
+      self.submitDeferred()
+    finally:
+      # Always send the pending digest, wait for queued emails and close the connection
+      self.closeMailer(digest_subject=f'{self.args} digest')
     
 if __name__ == "__main__":
   main = Main()
+  if '--deferred' in sys.argv:
+    # Submit the prompts of the run as one batch instead of one chat completion per folder
+    sys.argv.remove('--deferred')
+    main.DEFERRED = True
 
   if len(sys.argv) > 1:
     if sys.argv[1] == '1':
@@ -0,0 +1,133 @@
+import threading
+from functools import lru_cache
+
+ARTICLE_FORMAT = '\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n'
+ARTICLES_HEADER = '\n\nNumber of articles: {count}\n'
+
+BOARD_ADVISOR_CONTEXT = [
+    'Context: My mission is to guide startups in the AI and sustainability space to build products that have a positive impact on the planet and the environment.',
+    'As a board advisor I want to make sure that every decision made considers the UN sustainable development goals and the impact our actions have.',
+    'The post must be written from the voice of the board advisor.',
+    'Do not use the context in the post. It\'s for your information only.',
+    'You should only talk about the insights and trends extracted from these articles with a bias towards process automation.',
+    'Word the insights as if I was commenting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.',
+    'The post must be written in UK English, focused on the key insights around AI and sustainability, and sound professional but not formal.',
+    'Mention that the links are in the first comment.',
+    'Finish with a call to action asking readers to comment on my posts.',
+    'All posts must include this at the bottom: Image source: DALL-E 3, as well as some hashtags related to the insights.'
+]
+
+# Static role and instructions come first and the variable payload last, so providers can cache the prompt prefix
+TEMPLATES = {
+    'feedlyInsights': {
+        'role': 'You are a research analyst writing in UK English.',
+        'instructions': [
+            'Extract the key insights & trends in UK English from the articles below and highlight any resources worth checking. For each key insight, mention the source article.'
+        ],
+        'header': ARTICLES_HEADER
+    },
+    'inoreaderInsights': {
+        'role': 'You are a board advisor specialising in AI sustainability.',
+        'instructions': [
+            'Extract the key insights & trends, as well as a summary of each article, in UK English from the articles below. For each key insight, list the source article including the title and the URL.'
+        ],
+        'header': ARTICLES_HEADER
+    },
+    'feedlyLinkedInPost': {
+        'role': 'You are a marketing manager working for a consultancy called ProfessionalPulse.',
+        'instructions': [
+            'Imagine that you are a marketing manager for a consultancy called ProfessionalPulse.',
+            'Context: At ProfessionalPulse, we\'re passionate about leveraging technology to transform the operations of Business Services teams within Professional Services Firms. '
+            'Our journey began in the dynamic realm of IT and consultancy, and was inspired by real-life challenges faced by these teams. '
+            'Today, we use our expertise and unique approach to help these teams navigate their challenges, boost efficiency, and strike a balance between their professional and personal lives. '
+            'Discover more about our ethos, our journey, and how we can help you.',
+            'Do not use the context in the post. It\'s for your information only.',
+            'You should only talk about the insights extracted from these articles with a bias towards process automation, and the links to the articles should be neatly listed at the very end of the post, after everything else.',
+            'Use numbers for each insight to point to the relevant article URL.',
+            'Word the insights as if I was commeting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.',
+            'The post must be written in UK English, focused on the key insights around AI and technology, and sound professional as the target audience are professionals.',
+            'Mention that the links are in the first comment and add the links at the bottom, listed by the number of the insight they belong to.',
+            'Finish with a call to action asking readers to message me on LinkedIn if they are interested in discussing either the insights or how I could help them.',
+            'All posts must include this at the bottom: Image source: DALL-E 3',
+            'You are tasked with extracting insights and generate a LinkedIn post including the links to the relevant articles from the articles below.'
+        ],
+        'header': ARTICLES_HEADER
+    },
+    'inoreaderLinkedInPost': {
+        'role': 'You are a board advisor operating as Chenot Consulting Ltd.',
+        'instructions': BOARD_ADVISOR_CONTEXT + [
+            'You are tasked with extracting insights and generating a LinkedIn post without icons, including the links to the relevant articles from the articles below.'
+        ],
+        'header': ARTICLES_HEADER
+    },
+    'insightsLinkedInPost': {
+        'role': 'You are a board advisor operating as Chenot Consulting Ltd.',
+        'instructions': BOARD_ADVISOR_CONTEXT + [
+            'You are tasked with generating a LinkedIn post including the links to the relevant articles from the insights below, generated from the URLs that follow them.'
+        ],
+        'header': '\n'
+    }
+}
+
+class PromptTemplate():
+    """
+    A compiled prompt: a static role and instruction prefix followed by the variable payload
+    """
+    def __init__(self, role, instructions, header):
+        self.role = role
+        self.prefix = '\n'.join(instructions)
+        self.header = header
+
+    def render(self, payload, count=0):
+        return ''.join([self.prefix, self.header.format(count=count), *payload])
+
+@lru_cache(maxsize=256)
+def compileTemplate(role, instructions, header):
+    return PromptTemplate(role=role, instructions=instructions, header=header)
+
+def getTemplate(name, overrides=None, role=None, instructions=None):
+    """
+    Return the compiled template, with the user's overrides from the config document or the request applied
+    """
+    template = TEMPLATES[name]
+    override = (overrides or {}).get(name, {})
+    role = role or override.get('role') or template['role']
+    instructions = instructions or override.get('instructions') or template['instructions']
+    if isinstance(instructions, str):
+        instructions = [instructions]
+
+    return compileTemplate(role, tuple(instructions), template['header'])
+
+def articlePayload(urls, titles, summaries, contents):
+    return [ARTICLE_FORMAT.format(url=url, title=title, summary=summary, content=content) for url, title, summary, content in zip(urls, titles, summaries, contents)]
+
+class PromptUsage():
+    """
+    Prompt and cached token usage reported by the API, to measure the prefix caching
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+
+    def record(self, usage):
+        usage = usage or {}
+        details = usage.get('prompt_tokens_details') or {}
+        with self.lock:
+            self.calls += 1
+            self.prompt_tokens += usage.get('prompt_tokens', 0) or 0
+            self.cached_tokens += details.get('cached_tokens', 0) or 0
+            self.completion_tokens += usage.get('completion_tokens', 0) or 0
+        return details.get('cached_tokens', 0) or 0
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'promptTokens': self.prompt_tokens,
+                'cachedTokens': self.cached_tokens,
+                'completionTokens': self.completion_tokens,
+                'cachedRatio': round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens > 0 else None
+            }
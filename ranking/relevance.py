@@ -0,0 +1,58 @@
+import re
+import logging
+import numpy as np
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from', 'has', 'have', 'in', 'into', 'is', 'it',
+    'its', 'of', 'on', 'or', 'that', 'the', 'their', 'this', 'to', 'was', 'were', 'will', 'with', 'you', 'your'
+}
+
+class RelevanceRanker():
+    """
+    Offline BM25 ranking of articles against a topic profile
+    """
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+    def tokenize(self, text):
+        text = re.sub(r'<[^>]+>', ' ', str(text or '')).lower()
+        return [token for token in re.findall(r'[a-z0-9]+', text) if token not in STOPWORDS and len(token) > 1]
+
+    def score(self, documents, query):
+        """
+        Return a BM25 score for each document against the query terms
+        """
+        query_terms = list(dict.fromkeys(self.tokenize(query)))
+        if len(documents) == 0 or len(query_terms) == 0:
+            return np.zeros(len(documents))
+
+        vocabulary = {term: index for index, term in enumerate(query_terms)}
+        term_freqs = np.zeros((len(documents), len(query_terms)))
+        doc_lengths = np.zeros(len(documents))
+
+        for row, document in enumerate(documents):
+            tokens = self.tokenize(document)
+            doc_lengths[row] = len(tokens)
+            for token in tokens:
+                column = vocabulary.get(token)
+                if column is not None:
+                    term_freqs[row, column] += 1
+
+        doc_freqs = np.count_nonzero(term_freqs, axis=0)
+        idf = np.log(1 + (len(documents) - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        avg_length = doc_lengths.mean() if doc_lengths.mean() > 0 else 1
+        norm = self.k1 * (1 - self.b + self.b * doc_lengths / avg_length)
+        weights = term_freqs * (self.k1 + 1) / (term_freqs + norm[:, None])
+
+        return weights @ idf
+
+    def rank(self, documents, query, top_k=None):
+        """
+        Return document indices ordered by relevance, keeping the original order for ties
+        """
+        scores = self.score(documents, query)
+        order = np.argsort(-scores, kind='stable').tolist()
+        logging.info(f'Ranked {len(documents)} articles against topic profile. Top scores: {sorted(scores.tolist(), reverse=True)[:5]}')
+
+        return order[:top_k] if top_k else order
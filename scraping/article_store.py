@@ -0,0 +1,87 @@
+import os
+import time
+import uuid
+import hashlib
+import logging
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+TRACKING_PREFIXES = ('utm_',)
+TRACKING_PARAMETERS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid', 'ref'}
+
+class ArticleStore():
+    """
+    Articles extracted once and shared by every user's runs, coordinated with leases
+    """
+    def __init__(self, mongo):
+        self.mongo = mongo
+        self.owner = str(uuid.uuid4())
+        self.max_age = int(os.getenv('ARTICLE_STORE_MAX_AGE', 7 * 24 * 3600))
+        self.lease_seconds = int(os.getenv('ARTICLE_STORE_LEASE', 120))
+        self.wait_seconds = float(os.getenv('ARTICLE_STORE_WAIT', 60))
+        self.retry_seconds = int(os.getenv('ARTICLE_STORE_RETRY', 600))
+
+    def canonicalUrl(self, url):
+        parts = urlsplit(url.strip())
+        query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if not self.isTrackingParameter(key)]
+        path = parts.path.rstrip('/') or '/'
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, urlencode(sorted(query)), ''))
+
+    def isTrackingParameter(self, key):
+        key = key.lower()
+        return key in TRACKING_PARAMETERS or key.startswith(TRACKING_PREFIXES)
+
+    def urlHash(self, url):
+        return hashlib.sha256(self.canonicalUrl(url).encode('utf-8')).hexdigest()
+
+    def findFresh(self, url_hash):
+        article = self.mongo.findArticle(url_hash)
+        if article is None:
+            return None
+
+        # Failed extractions are only kept long enough to stop every worker retrying the URL at once
+        max_age = self.retry_seconds if article.get('outcome') == 'failed' else self.max_age
+        if article.get('fetchedAt', 0) >= time.time() - max_age:
+            return article
+        return None
+
+    def getContent(self, url, title, extract, count_tokens):
+        """
+        Return the stored content of the article, extracting and storing it if no other worker is already doing so
+        """
+        url_hash = self.urlHash(url)
+        article = self.findFresh(url_hash)
+        if article is not None:
+            logging.info(f'Using stored article for {url}')
+            return article['content']
+
+        deadline = time.monotonic() + self.wait_seconds
+        while not self.mongo.acquireArticleLease(url_hash, self.owner, self.lease_seconds):
+            # Another worker is scraping this URL, wait for its result
+            if time.monotonic() > deadline:
+                logging.warning(f'Timed out waiting for the article lease of {url}, extracting it anyway')
+                break
+            time.sleep(2)
+            article = self.findFresh(url_hash)
+            if article is not None:
+                logging.info(f'Using article stored by another worker for {url}')
+                return article['content']
+
+        try:
+            start = time.monotonic()
+            content = extract(url)
+            if not content:
+                logging.warning(f'Could not extract article {url}, it will be retried in {self.retry_seconds} seconds')
+            self.mongo.saveArticle({
+                'urlHash': url_hash,
+                'url': self.canonicalUrl(url),
+                'title': title,
+                'content': content,
+                'outcome': 'extracted' if content else 'failed',
+                'tokens': count_tokens(content) if content else 0,
+                'fetchedAt': int(time.time()),
+                'fetchSeconds': round(time.monotonic() - start, 3),
+                'bytes': len(content.encode('utf-8'))
+            })
+            return content
+        finally:
+            self.mongo.releaseArticleLease(url_hash, self.owner)
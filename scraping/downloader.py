@@ -0,0 +1,120 @@
+import os
+import re
+import time
+import logging
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+
+class ArticleDownloader():
+    """
+    Bounded, streaming article downloads over a pooled session
+    """
+    ALLOWED_CONTENT_TYPES = ('text/html', 'application/xhtml+xml', 'text/plain')
+    # Pages have a single main element, unlike article elements which also wrap teasers in navigation and sidebars
+    MAIN_TAG = re.compile(rb'<(/?)main\b[^>]*>', re.IGNORECASE)
+
+    def __init__(self):
+        self.connect_timeout = float(os.getenv('ARTICLE_CONNECT_TIMEOUT', 5))
+        self.read_timeout = float(os.getenv('ARTICLE_READ_TIMEOUT', 10))
+        self.max_seconds = float(os.getenv('ARTICLE_MAX_SECONDS', 20))
+        self.max_bytes = int(os.getenv('ARTICLE_MAX_BYTES', 2 * 1024 * 1024))
+        self.chunk_size = 64 * 1024
+        self.outcomes = deque(maxlen=int(os.getenv('ARTICLE_OUTCOMES_KEPT', 500)))
+
+        self.session = requests.Session()
+        self.session.headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+        adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def download(self, url):
+        """
+        Return the decoded body of the page, or None if it could not be downloaded or is not an article
+        """
+        outcome = {'url': url, 'status': None, 'bytes': 0, 'duration': 0.0, 'truncated': False, 'articleEnd': False, 'timedOut': False, 'skipped': False}
+        start = time.monotonic()
+        body = None
+
+        try:
+            with self.session.get(url, stream=True, timeout=(self.connect_timeout, self.read_timeout)) as response:
+                outcome['status'] = response.status_code
+                content_type = response.headers.get('Content-Type', 'text/html').split(';')[0].strip().lower()
+
+                if response.status_code != 200:
+                    logging.warning(f'Could not download article {url} with status code: {response.status_code}')
+                elif content_type not in self.ALLOWED_CONTENT_TYPES:
+                    outcome['skipped'] = True
+                    logging.info(f'Skipping article {url} with content type: {content_type}')
+                else:
+                    chunks = []
+                    tail = b''
+                    depth = 0
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        chunks.append(chunk)
+                        outcome['bytes'] += len(chunk)
+
+                        if outcome['bytes'] >= self.max_bytes:
+                            outcome['truncated'] = True
+                            break
+                        # Stop once the outermost main element has closed, counting its tags across chunk boundaries
+                        depth, closed, tail = self.scanMain(tail + chunk, depth)
+                        if closed:
+                            outcome['articleEnd'] = True
+                            outcome['truncated'] = True
+                            break
+                        if time.monotonic() - start > self.max_seconds:
+                            outcome['truncated'] = True
+                            outcome['timedOut'] = True
+                            break
+
+                    body = b''.join(chunks)[:self.max_bytes].decode(response.encoding or 'utf-8', errors='replace')
+        except requests.exceptions.Timeout as e:
+            outcome['timedOut'] = True
+            logging.warning(f'Timed out downloading article {url}: {e}')
+        except requests.exceptions.RequestException as e:
+            logging.warning(f'Error downloading article {url}: {e}')
+
+        outcome['duration'] = round(time.monotonic() - start, 3)
+        self.outcomes.append(outcome)
+        logging.info(f'Fetched article {url}: {outcome}')
+
+        return body
+
+    def scanMain(self, data, depth):
+        """
+        Count the main element tags in data from the given nesting depth.
+        Returns the new depth, whether the outermost main element closed and the tail to carry over to the next chunk
+        """
+        end = 0
+        for match in self.MAIN_TAG.finditer(data):
+            if not match.group(1):
+                depth += 1
+            elif depth == 1:
+                return 0, True, b''
+            else:
+                depth = max(depth - 1, 0)
+            end = match.end()
+        # Keep the end of the data in case a tag is split across chunks, without counting a matched tag twice
+        return depth, False, data[max(end, len(data) - 256):]
+
+    def getStats(self):
+        """
+        Summarise the recent fetch outcomes to track tail latency
+        """
+        outcomes = list(self.outcomes)
+        durations = sorted(o['duration'] for o in outcomes)
+
+        def percentile(p):
+            return durations[min(len(durations) - 1, int(p * len(durations)))] if durations else None
+
+        return {
+            'fetches': len(outcomes),
+            'bytes': sum(o['bytes'] for o in outcomes),
+            'truncated': sum(1 for o in outcomes if o['truncated']),
+            'timedOut': sum(1 for o in outcomes if o['timedOut']),
+            'skipped': sum(1 for o in outcomes if o['skipped']),
+            'p50': percentile(0.50),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99)
+        }
@@ -0,0 +1,73 @@
+import os
+import sys
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scraping.downloader import ArticleDownloader
+
+CHUNK = 64 * 1024
+
+def padding(size):
+    return ('<p>' + 'x' * 96 + '</p>\n') * (size // 104) + ' ' * (size % 104)
+
+def splitClosingTag():
+    # The closing main tag straddles the first chunk boundary
+    head = '<html><body><main><article><p>Split body</p></article>'
+    return head + padding(CHUNK - len(head) - 3) + '</main>' + padding(3 * CHUNK) + '</body></html>'
+
+PAGES = {
+    # A teaser article in the navigation closes in the first chunk, the body comes in a later one
+    '/teaser-first': '<html><body><nav><article><p>Teaser</p></article></nav>' + padding(2 * CHUNK) + '<main><article><p>Real body</p></article></main></body></html>',
+    # The main element closes early and is followed by a long footer that isn't worth downloading
+    '/long-footer': '<html><body><main><article><p>Short body</p></article></main>' + padding(4 * CHUNK) + '</body></html>',
+    '/split-tag': splitClosingTag(),
+    # Without a main element the whole page is read
+    '/no-main': '<html><body><article><p>Plain body</p></article>' + padding(2 * CHUNK) + '<footer>End</footer></body></html>'
+}
+
+class PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = PAGES[self.path].encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def check(downloader, base_url, path, expected, articleEnd):
+    body = downloader.download(f'{base_url}{path}')
+    outcome = downloader.outcomes[-1]
+    if body is None or expected not in body:
+        raise AssertionError(f'{path} is missing "{expected}": {outcome}')
+    if outcome['articleEnd'] != articleEnd or outcome['truncated'] != articleEnd:
+        raise AssertionError(f'{path} has unexpected outcome: {outcome}')
+    if not articleEnd and outcome['bytes'] != len(PAGES[path].encode('utf-8')):
+        raise AssertionError(f'{path} was not read in full: {outcome}')
+
+def runSmokeCheck():
+    """
+    Download pages with different layouts from a local server and check the early stop keeps the article body
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    try:
+        downloader = ArticleDownloader()
+        check(downloader, base_url, '/teaser-first', 'Real body', articleEnd=True)
+        check(downloader, base_url, '/long-footer', 'Short body', articleEnd=True)
+        check(downloader, base_url, '/split-tag', 'Split body', articleEnd=True)
+        check(downloader, base_url, '/no-main', '<footer>End</footer>', articleEnd=False)
+
+        logging.info(f'Download smoke check passed for {len(PAGES)} pages')
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    runSmokeCheck()